@@ -0,0 +1,339 @@
+"""Load test and benchmark for the server.py endpoints.
+
+Starts server.py in its own uvicorn process against the fake storage API in
+benchmarks/fake_storage.py and the stub gpte in benchmarks/fake_gpte.py, creates
+synthetic projects of several sizes and measures /run, /build, /improve,
+/download, /preview and /file. The first build of each project is reported as
+buildCold; later builds of the unchanged project are fingerprint skips. Results
+(p50/p99 latency, requests per second, bytes moved and the server process's RSS
+before, after and at its sampled peak during each endpoint) are written as JSON
+so runs can be compared:
+
+    python -m benchmarks.bench_server --sizes 10,100,1000,5000 --output bench.json
+    python -m benchmarks.bench_server --compare bench.json --fail-on-regression 20
+
+Projects are created under /tmp/projects like in production and removed at the end.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_uvicorn(app, port):
+    """Run an ASGI app with uvicorn in a daemon thread and wait until it accepts connections"""
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    server.install_signal_handlers = lambda: None
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.time() + 30
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError(f"Server on port {port} did not start")
+        time.sleep(0.05)
+    return server, thread
+
+def start_server_process(port):
+    """Run server.py under uvicorn in a child process and wait until it accepts connections"""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+    )
+    deadline = time.time() + 60
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return process
+        except OSError:
+            if time.time() > deadline:
+                process.kill()
+                raise RuntimeError(f"Server on port {port} did not start")
+            time.sleep(0.1)
+
+def stop_server_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def install_fake_gpte(bin_dir):
+    """Put the stub gpte first on PATH"""
+    gpte = os.path.join(bin_dir, "gpte")
+    with open(gpte, "w") as f:
+        f.write(f"#!/bin/sh\nexec {sys.executable} {os.path.join(ROOT, 'benchmarks', 'fake_gpte.py')} \"$@\"\n")
+    os.chmod(gpte, os.stat(gpte).st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+def populate_project(proj, files, file_bytes, asset_ratio=0.1, seed=0):
+    """Fill a workspace with `files` synthetic source files and binary assets"""
+    rng = random.Random(seed)
+    for i in range(files):
+        if i < files * asset_ratio:
+            path = os.path.join(proj, "assets", f"dir{i % 20}", f"sprite{i}.png")
+            data = rng.randbytes(file_bytes)
+        else:
+            path = os.path.join(proj, "src", f"dir{i % 50}", f"module{i}.js")
+            data = (f"export const value{i} = {i};\n" * (file_bytes // 24 + 1))[:file_bytes].encode()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def rss_mb(pid):
+    """Current resident set size of a process in MiB, or None if it cannot be read"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        # ps reports KiB on Linux and macOS
+        output = subprocess.run(["ps", "-o", "rss=", "-p", str(pid)], capture_output=True, text=True, check=True).stdout
+        return round(int(output.strip()) / 1024, 1)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+async def sample_rss(pid, samples, interval=0.05):
+    """Append the RSS of a process to `samples` until cancelled"""
+    while True:
+        rss = await asyncio.to_thread(rss_mb, pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(interval)
+
+async def measure(client, name, make_request, count, concurrency, storage_url, server_pid):
+    """Send `count` requests with up to `concurrency` in flight and summarize them
+
+    Memory is the server process's RSS, sampled while only this endpoint runs.
+    """
+    latencies = []
+    errors = 0
+    response_bytes = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    before = (await client.get(f"{storage_url}/__stats")).json()
+    rss_before = rss_mb(server_pid)
+    rss_samples = [rss_before] if rss_before is not None else []
+    sampler = asyncio.create_task(sample_rss(server_pid, rss_samples))
+
+    async def one(i):
+        nonlocal errors, response_bytes
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await make_request(i)
+                response_bytes += len(response.content)
+                if response.status_code >= 400:
+                    errors += 1
+            except Exception as e:
+                print(f"{name} request failed: {e}")
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(one(i) for i in range(count)))
+    finally:
+        sampler.cancel()
+    wall = time.perf_counter() - started
+    after = (await client.get(f"{storage_url}/__stats")).json()
+    rss_after = rss_mb(server_pid)
+
+    result = {
+        "requests": count,
+        "errors": errors,
+        "p50Ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99Ms": round(percentile(latencies, 99) * 1000, 2),
+        "meanMs": round(sum(latencies) / len(latencies) * 1000, 2),
+        "rps": round(count / wall, 2) if wall else None,
+        "responseBytes": response_bytes,
+        "storageUploadedBytes": after["uploadedBytes"] - before["uploadedBytes"],
+        "storageDownloadedBytes": after["downloadedBytes"] - before["downloadedBytes"],
+        "storageRequests": after["requests"] - before["requests"] - 1,
+        "rssBeforeMb": rss_before,
+        "rssAfterMb": rss_after,
+        "rssDeltaMb": round(rss_after - rss_before, 1) if rss_before is not None and rss_after is not None else None,
+        "rssPeakMb": max(rss_samples + [rss_after or 0]) if rss_samples else rss_after,
+    }
+    rss = f"rss {result['rssDeltaMb']:+} MB  " if result["rssDeltaMb"] is not None else ""
+    print(f"  {name:<13} p50 {result['p50Ms']:>9} ms  p99 {result['p99Ms']:>9} ms  {result['rps']:>8} req/s  {rss}errors {errors}")
+    return result
+
+async def run_size(client, base_url, storage_url, server_pid, size, args):
+    """Benchmark every endpoint against one project of `size` files"""
+    print(f"Project with {size} files")
+    results = {}
+    wait = {"wait": True}
+
+    results["run"] = await measure(
+        client, "/run",
+        lambda i: client.post(f"{base_url}/run", json={"prompt": f"benchmark game {size} {i} {time.time()}"}),
+        args.requests, args.concurrency, storage_url, server_pid)
+
+    response = await client.post(f"{base_url}/run", json={"prompt": f"benchmark project {size} {time.time()}"})
+    job_id = response.json()["jobId"]
+    await asyncio.to_thread(populate_project, f"/tmp/projects/{job_id}", size, args.file_bytes)
+
+    # Builds and improves of one project are serialized, so these run one at a time.
+    # Only the first build does any work; the rest find the sources unchanged and are skipped
+    results["buildCold"] = await measure(
+        client, "/build (cold)",
+        lambda i: client.post(f"{base_url}/build", json={"jobId": job_id, **wait}),
+        1, 1, storage_url, server_pid)
+    results["build"] = await measure(
+        client, "/build",
+        lambda i: client.post(f"{base_url}/build", json={"jobId": job_id, **wait}),
+        args.requests, 1, storage_url, server_pid)
+    results["improve"] = await measure(
+        client, "/improve",
+        lambda i: client.post(f"{base_url}/improve", json={"jobId": job_id, "prompt": f"tweak {i} {time.time()}", **wait}),
+        args.requests, 1, storage_url, server_pid)
+
+    results["download"] = await measure(
+        client, "/download", lambda i: client.get(f"{base_url}/download/{job_id}"),
+        args.requests, args.concurrency, storage_url, server_pid)
+    results["preview"] = await measure(
+        client, "/preview", lambda i: client.get(f"{base_url}/preview/{job_id}"),
+        args.requests * 10, args.concurrency, storage_url, server_pid)
+    results["file"] = await measure(
+        client, "/file", lambda i: client.get(f"{base_url}/file/{job_id}/main.js"),
+        args.requests * 10, args.concurrency, storage_url, server_pid)
+    return job_id, results
+
+def compare(baseline, current, threshold):
+    """Print p50/p99 changes against a baseline run; return the regressions over threshold %"""
+    regressions = []
+    for size, endpoints in current["results"].items():
+        for endpoint, result in endpoints.items():
+            base = baseline.get("results", {}).get(size, {}).get(endpoint)
+            if not base:
+                continue
+            for metric in ("p50Ms", "p99Ms"):
+                if not base[metric]:
+                    continue
+                change = (result[metric] - base[metric]) / base[metric] * 100
+                flag = "REGRESSION" if change > threshold else ""
+                print(f"{size:>6} {endpoint:<9} {metric}: {base[metric]:>9} -> {result[metric]:>9} ms ({change:+.1f}%) {flag}")
+                if change > threshold:
+                    regressions.append((size, endpoint, metric, change))
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+async def main_async(args):
+    import httpx
+
+    storage_port = free_port()
+    os.environ["SUPABASE_URL"] = f"http://127.0.0.1:{storage_port}"
+    os.environ["SUPABASE_SERVICE_ROLE_KEY"] = "bench.bench.bench"
+    os.environ["FAKE_STORAGE_LATENCY"] = str(args.storage_latency)
+    os.environ["FAKE_GPTE_DELAY"] = str(args.gpte_delay)
+    os.environ["FAKE_GPTE_LINES"] = str(args.gpte_lines)
+    os.environ["FAKE_GPTE_LINE_BYTES"] = str(args.gpte_line_bytes)
+    # Build processes only see allowlisted variables
+    os.environ["BUILD_ENV_ALLOW"] = "FAKE_GPTE_*"
+
+    bin_dir = tempfile.mkdtemp(prefix="bench-bin-")
+    install_fake_gpte(bin_dir)
+    sys.path.insert(0, ROOT)
+    from benchmarks import fake_storage
+    storage_server, _ = start_uvicorn(fake_storage.app, storage_port)
+    # The server gets its own process so its memory is not mixed with the client's
+    server_port = free_port()
+    server_process = start_server_process(server_port)
+
+    base_url = f"http://127.0.0.1:{server_port}"
+    storage_url = os.environ["SUPABASE_URL"]
+    report = {
+        "startedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": vars(args),
+        "results": {},
+    }
+    job_ids = []
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+        async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+            for size in args.sizes:
+                job_id, results = await run_size(client, base_url, storage_url, server_process.pid, size, args)
+                job_ids.append(job_id)
+                report["results"][str(size)] = results
+        report["peakRssMb"] = max(
+            (result["rssPeakMb"] for results in report["results"].values() for result in results.values() if result["rssPeakMb"]),
+            default=None,
+        )
+    finally:
+        stop_server_process(server_process)
+        storage_server.should_exit = True
+        for job_id in job_ids:
+            shutil.rmtree(f"/tmp/projects/{job_id}", ignore_errors=True)
+        shutil.rmtree(bin_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,1000,5000", type=lambda value: [int(size) for size in value.split(",")],
+                        help="comma separated project sizes (files)")
+    parser.add_argument("--requests", type=int, default=5, help="requests per endpoint (x10 for /preview and /file)")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight for read endpoints")
+    parser.add_argument("--file-bytes", type=int, default=2048, help="size of each synthetic file")
+    parser.add_argument("--gpte-delay", type=float, default=0.5, help="seconds the stub gpte runs")
+    parser.add_argument("--gpte-lines", type=int, default=200, help="lines of output from the stub gpte")
+    parser.add_argument("--gpte-line-bytes", type=int, default=120, help="bytes per stub gpte output line")
+    parser.add_argument("--storage-latency", type=float, default=0.0, help="simulated storage round trip in seconds")
+    parser.add_argument("--timeout", type=float, default=600, help="per-request timeout in seconds")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the JSON report")
+    parser.add_argument("--compare", help="baseline JSON report to compare against")
+    parser.add_argument("--fail-on-regression", type=float, default=None,
+                        help="exit non-zero if p50/p99 regress by more than this percent against --compare")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.fail_on_regression or 0)
+        if args.fail_on_regression is not None and regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
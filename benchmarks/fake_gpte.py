@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""Stub for the gpte executable used by /improve in benchmarks.
+
+Called the same way as the real tool (`gpte [options] <project dir>`), it waits
+FAKE_GPTE_DELAY seconds, prints FAKE_GPTE_LINES lines of FAKE_GPTE_LINE_BYTES bytes
+spread over that time, appends a comment to main.js so the run changes the project,
+and exits with FAKE_GPTE_EXIT_CODE.
+"""
+import os
+import sys
+import time
+
+def main():
+    delay = float(os.environ.get("FAKE_GPTE_DELAY", "0.5"))
+    lines = int(os.environ.get("FAKE_GPTE_LINES", "100"))
+    line_bytes = int(os.environ.get("FAKE_GPTE_LINE_BYTES", "80"))
+    exit_code = int(os.environ.get("FAKE_GPTE_EXIT_CODE", "0"))
+    proj_dir = sys.argv[-1]
+
+    pause = delay / lines if lines else 0
+    for i in range(lines):
+        print(f"[fake-gpte] {i:06d} " + "x" * max(0, line_bytes - 20), flush=True)
+        if pause:
+            time.sleep(pause)
+    if not lines:
+        time.sleep(delay)
+
+    with open(os.path.join(proj_dir, "main.js"), "a") as f:
+        f.write(f"// improved at {time.time()}\n")
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""In-memory stand-in for the Supabase Storage API, for benchmarks and local testing.
+
+It implements just the storage endpoints server.py uses (buckets, upload, download,
+list, remove and signed URLs) under /storage/v1, keeps objects in memory and counts
+requests and bytes so a benchmark can report how much data moved. Run it on its own
+with:
+
+    uvicorn benchmarks.fake_storage:app --port 54321
+
+and point the server at it with SUPABASE_URL=http://127.0.0.1:54321 and any
+SUPABASE_SERVICE_ROLE_KEY (e.g. "bench.bench.bench").
+"""
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from email.parser import BytesParser
+from email.policy import HTTP
+import asyncio
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+app = FastAPI()
+
+# Simulated network round trip added to every request, in seconds
+LATENCY = float(os.environ.get("FAKE_STORAGE_LATENCY", "0"))
+
+BUCKETS = {"game-builds": {"id": "game-builds", "name": "game-builds", "public": True}}
+OBJECTS = {}
+lock = threading.Lock()
+STATS = {"requests": 0, "uploads": 0, "downloads": 0, "uploadedBytes": 0, "downloadedBytes": 0}
+
+def not_found(message="Object not found"):
+    return JSONResponse({"statusCode": "404", "error": "not_found", "message": message}, status_code=404)
+
+def parse_upload(content_type, body):
+    """Return the file bytes of a multipart upload, or the raw body"""
+    if not content_type.startswith("multipart/form-data"):
+        return body, content_type
+    message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    for part in message.iter_parts():
+        if part.get_param("name", header="content-disposition") == "file":
+            return part.get_payload(decode=True) or b"", part.get_content_type()
+    raise HTTPException(status_code=400, detail="No file in upload")
+
+@app.middleware("http")
+async def count_and_delay(request: Request, call_next):
+    with lock:
+        STATS["requests"] += 1
+    if LATENCY:
+        await asyncio.sleep(LATENCY)
+    return await call_next(request)
+
+@app.get("/__stats")
+async def get_stats():
+    with lock:
+        return {**STATS, "objects": len(OBJECTS), "bytes": sum(len(obj["data"]) for obj in OBJECTS.values())}
+
+@app.post("/__reset")
+async def reset():
+    with lock:
+        OBJECTS.clear()
+        for key in STATS:
+            STATS[key] = 0
+    return {"ok": True}
+
+@app.get("/storage/v1/bucket/{bucket_id}")
+async def get_bucket(bucket_id: str):
+    if bucket_id not in BUCKETS:
+        return not_found("Bucket not found")
+    return BUCKETS[bucket_id]
+
+@app.post("/storage/v1/bucket")
+async def create_bucket(request: Request):
+    data = await request.json()
+    bucket_id = data.get("id") or data.get("name")
+    BUCKETS[bucket_id] = {"id": bucket_id, "name": data.get("name", bucket_id), "public": data.get("public", False)}
+    return {"name": bucket_id}
+
+@app.post("/storage/v1/object/list/{bucket}")
+async def list_objects(bucket: str, request: Request):
+    data = await request.json()
+    prefix = data.get("prefix", "").strip("/")
+    limit = int(data.get("limit", 100))
+    offset = int(data.get("offset", 0))
+
+    entries = {}
+    with lock:
+        for key, obj in OBJECTS.items():
+            obj_bucket, _, path = key.partition("/")
+            if obj_bucket != bucket or not path.startswith(prefix + "/" if prefix else ""):
+                continue
+            rest = path[len(prefix) + 1:] if prefix else path
+            name, _, nested = rest.partition("/")
+            if nested:
+                entries.setdefault(name, {"name": name, "id": None, "updated_at": None, "created_at": None, "metadata": None})
+            else:
+                entries[name] = {
+                    "name": name,
+                    "id": obj["id"],
+                    "updated_at": obj["updatedAt"],
+                    "created_at": obj["createdAt"],
+                    "last_accessed_at": obj["updatedAt"],
+                    "metadata": {
+                        "eTag": f'"{obj["etag"]}"',
+                        "size": len(obj["data"]),
+                        "mimetype": obj["contentType"],
+                        "lastModified": obj["updatedAt"],
+                    },
+                }
+    ordered = [entries[name] for name in sorted(entries)]
+    return ordered[offset:offset + limit]
+
+@app.post("/storage/v1/object/sign/{bucket}")
+async def sign_many(bucket: str, request: Request):
+    data = await request.json()
+    return [
+        {"path": path, "signedURL": f"/object/sign/{bucket}/{path}?token={uuid.uuid4().hex}", "error": None}
+        for path in data.get("paths", [])
+    ]
+
+@app.post("/storage/v1/object/sign/{bucket}/{path:path}")
+async def sign_one(bucket: str, path: str):
+    if f"{bucket}/{path}" not in OBJECTS:
+        return not_found()
+    return {"signedURL": f"/object/sign/{bucket}/{path}?token={uuid.uuid4().hex}"}
+
+@app.delete("/storage/v1/object/{bucket}")
+async def remove_objects(bucket: str, request: Request):
+    data = await request.json()
+    removed = []
+    with lock:
+        for path in data.get("prefixes", []):
+            if OBJECTS.pop(f"{bucket}/{path}", None) is not None:
+                removed.append({"name": path})
+    return removed
+
+@app.api_route("/storage/v1/object/{bucket}/{path:path}", methods=["POST", "PUT"])
+async def upload_object(bucket: str, path: str, request: Request):
+    body = await request.body()
+    data, content_type = parse_upload(request.headers.get("content-type", ""), body)
+    now = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+    key = f"{bucket}/{path}"
+    with lock:
+        existing = OBJECTS.get(key)
+        if existing and request.method == "POST" and request.headers.get("x-upsert", "false") != "true":
+            raise HTTPException(status_code=409, detail="The resource already exists")
+        OBJECTS[key] = {
+            "id": existing["id"] if existing else str(uuid.uuid4()),
+            "data": data,
+            "contentType": request.headers.get("x-content-type") or content_type,
+            "etag": hashlib.md5(data).hexdigest(),
+            "createdAt": existing["createdAt"] if existing else now,
+            "updatedAt": now,
+        }
+        STATS["uploads"] += 1
+        STATS["uploadedBytes"] += len(data)
+    return {"Key": key}
+
+@app.get("/storage/v1/object/{bucket}/{path:path}")
+async def download_object(bucket: str, path: str):
+    with lock:
+        obj = OBJECTS.get(f"{bucket}/{path}")
+        if obj is None:
+            return not_found()
+        STATS["downloads"] += 1
+        STATS["downloadedBytes"] += len(obj["data"])
+    return Response(obj["data"], media_type=obj["contentType"], headers={"ETag": f'"{obj["etag"]}"'})
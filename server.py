@@ -1,19 +1,49 @@
 from fastapi import FastAPI, BackgroundTasks, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 import asyncio
+import io
 import os
 import requests
 import shutil
 import subprocess
+import threading
 import traceback
 import uuid
 import zipfile
 import tempfile
 import json
+import email.utils
+import fcntl
+import fnmatch
+import gzip
+import mimetypes
+import multiprocessing
+import hashlib
+import random
+import re
+import resource
+import signal
+import socket
+import sqlite3
+import string
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from typing import Dict, List, Optional
-from supabase import create_client, Client
 import base64
+import difflib
+import httpx
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = FastAPI()
 
@@ -30,59 +60,1723 @@ app.add_middleware(
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 
-# Initialize Supabase client if environment variables are set
-supabase: Optional[Client] = None
-if SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY:
-    supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+# Job queue configuration: number of workers running builds/improves and how
+# many tasks may wait in the queue before new requests are rejected
+TASK_WORKERS = int(os.environ.get("TASK_WORKERS", "2"))
+MAX_QUEUED_TASKS = int(os.environ.get("MAX_QUEUED_TASKS", "32"))
+MAX_FINISHED_TASKS = int(os.environ.get("MAX_FINISHED_TASKS", "1000"))
+
+# Storage transfer configuration: how many uploads/downloads run at once and how
+# often a failed transfer is retried (with exponential backoff)
+STORAGE_CONCURRENCY = int(os.environ.get("STORAGE_CONCURRENCY", "8"))
+STORAGE_RETRIES = int(os.environ.get("STORAGE_RETRIES", "3"))
+STORAGE_RETRY_BACKOFF = float(os.environ.get("STORAGE_RETRY_BACKOFF", "0.5"))
+# Storage HTTP client: per-request timeouts (seconds) and how long idle
+# keep-alive connections are kept open
+STORAGE_TIMEOUT = float(os.environ.get("STORAGE_TIMEOUT", "60"))
+STORAGE_CONNECT_TIMEOUT = float(os.environ.get("STORAGE_CONNECT_TIMEOUT", "10"))
+STORAGE_KEEPALIVE_SECONDS = float(os.environ.get("STORAGE_KEEPALIVE_SECONDS", "30"))
+# How long a worker thread waits for a storage call (a whole batch, with retries)
+# before giving up, and how many threads do file I/O for storage transfers
+STORAGE_CALL_TIMEOUT = float(os.environ.get("STORAGE_CALL_TIMEOUT", "900"))
+STORAGE_IO_THREADS = int(os.environ.get("STORAGE_IO_THREADS", str(STORAGE_CONCURRENCY * 2)))
+# Entries requested per page when listing storage folders
+STORAGE_LIST_PAGE_SIZE = int(os.environ.get("STORAGE_LIST_PAGE_SIZE", "1000"))
+
+# Incremental sync: the manifest of content hashes kept for each project (locally
+# under MANIFEST_ROOT, outside the workspace gpte reads, and as MANIFEST_NAME next
+# to the project files in storage), and the files that are never synced to storage
+# (extra patterns can be added with SYNC_IGNORE, comma separated; a trailing "/"
+# matches a directory)
+MANIFEST_NAME = ".sync-manifest.json"
+MANIFEST_ROOT = os.environ.get("MANIFEST_ROOT", "/tmp/manifests")
+SYNC_IGNORE = ["build.log", "build.log.*", MANIFEST_NAME, "node_modules/", "dist/", ".git/", "__pycache__/"] + [
+    pattern.strip() for pattern in os.environ.get("SYNC_IGNORE", "").split(",") if pattern.strip()
+]
+
+# Dependency cache for npm builds: a shared offline npm cache plus prepared
+# node_modules trees keyed on package.json and the lockfile, evicted LRU once
+# they use more than BUILD_CACHE_MAX_BYTES
+BUILD_CACHE_DIR = os.environ.get("BUILD_CACHE_DIR", "/tmp/build-cache")
+NPM_CACHE_DIR = os.path.join(BUILD_CACHE_DIR, "npm")
+NODE_MODULES_CACHE_DIR = os.path.join(BUILD_CACHE_DIR, "node_modules")
+BUILD_CACHE_MAX_BYTES = int(os.environ.get("BUILD_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+LOCKFILES = ["package-lock.json", "npm-shrinkwrap.json", "yarn.lock", "pnpm-lock.yaml"]
+
+# Streaming archives: chunk size used when reading files and flushing zip data,
+# and file types that are already compressed and are stored without deflating
+ZIP_CHUNK_SIZE = int(os.environ.get("ZIP_CHUNK_SIZE", str(256 * 1024)))
+PRECOMPRESSED_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".ico",
+    ".ogg", ".mp3", ".m4a", ".opus", ".mp4", ".webm",
+    ".woff", ".woff2", ".zip", ".gz", ".br", ".7z",
+}
+
+# Job logs: lines kept in memory per job for live subscribers, how many jobs keep
+# their buffer, and the default page size when reading logs from an offset
+LOG_BUFFER_LINES = int(os.environ.get("LOG_BUFFER_LINES", "2000"))
+LOG_BUFFER_JOBS = int(os.environ.get("LOG_BUFFER_JOBS", "256"))
+LOG_PAGE_LINES = int(os.environ.get("LOG_PAGE_LINES", "1000"))
+LOG_KEEPALIVE_SECONDS = float(os.environ.get("LOG_KEEPALIVE_SECONDS", "15"))
+# build.log is rotated into gzipped segments once it reaches LOG_ROTATE_BYTES
+# (keeping the newest LOG_KEEP_SEGMENTS), /logs without an offset returns the last
+# LOG_TAIL_LINES lines, and at most LOG_ECHO_LINES lines of each gpte run (cut to
+# LOG_ECHO_LINE_CHARS characters) are echoed to the console (-1 for all)
+LOG_ROTATE_BYTES = int(os.environ.get("LOG_ROTATE_BYTES", str(8 * 1024 * 1024)))
+LOG_KEEP_SEGMENTS = max(1, int(os.environ.get("LOG_KEEP_SEGMENTS", "5")))
+LOG_TAIL_LINES = int(os.environ.get("LOG_TAIL_LINES", "200"))
+LOG_ECHO_LINES = int(os.environ.get("LOG_ECHO_LINES", "200"))
+LOG_ECHO_LINE_CHARS = int(os.environ.get("LOG_ECHO_LINE_CHARS", "500"))
+
+# Prompt/result cache: how long results are reused (improve results are keyed on
+# the project's content so they can be kept much longer than /run results, which
+# only cover retries and double-clicks), how many entries are kept, where the
+# file contents of cached improve results live and how often blobs no entry can
+# still use are swept from there
+PROMPT_CACHE_TTL = float(os.environ.get("PROMPT_CACHE_TTL", str(24 * 3600)))
+PROMPT_CACHE_RUN_TTL = float(os.environ.get("PROMPT_CACHE_RUN_TTL", "120"))
+PROMPT_CACHE_MAX_ENTRIES = int(os.environ.get("PROMPT_CACHE_MAX_ENTRIES", "512"))
+PROMPT_CACHE_DIR = os.environ.get("PROMPT_CACHE_DIR", "/tmp/prompt-cache")
+PROMPT_CACHE_SWEEP_INTERVAL = float(os.environ.get("PROMPT_CACHE_SWEEP_INTERVAL", "3600"))
+
+# New projects from /run are kept in memory (and in storage) until a build or
+# improve needs them on disk; at most this many are held at once
+PENDING_SCAFFOLDS_MAX = int(os.environ.get("PENDING_SCAFFOLDS_MAX", "256"))
+
+# File patches: how many patches of a file are logged before the log is folded
+# into a snapshot, how long a PATCH waits for a running build or improve, and
+# how many bytes of recent file versions are kept to answer ?base= diffs
+PATCH_COMPACT_EVERY = int(os.environ.get("PATCH_COMPACT_EVERY", "50"))
+PATCH_LOCK_TIMEOUT = float(os.environ.get("PATCH_LOCK_TIMEOUT", "10"))
+FILE_VERSION_CACHE_BYTES = int(os.environ.get("FILE_VERSION_CACHE_BYTES", str(16 * 1024 * 1024)))
+
+# Preview asset serving: files up to PREVIEW_CACHE_MAX_FILE_BYTES are kept in an
+# in-process LRU cache bounded by PREVIEW_CACHE_MAX_BYTES in total
+PREVIEW_CACHE_MAX_BYTES = int(os.environ.get("PREVIEW_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+PREVIEW_CACHE_MAX_FILE_BYTES = int(os.environ.get("PREVIEW_CACHE_MAX_FILE_BYTES", str(1024 * 1024)))
+PREVIEW_CACHE_CONTROL = os.environ.get("PREVIEW_CACHE_CONTROL", "no-cache")
+
+# Asset optimization after builds (ASSET_OPTIMIZE=0 turns it off): files matching
+# ASSET_EXCLUDE are dropped from the dist, CSS/HTML are minified (JS too when
+# esbuild is on PATH), .gz/.br variants of text assets of at least
+# ASSET_COMPRESS_MIN_BYTES are written for serve_file and identical files are
+# hardlinked, across a pool of ASSET_WORKERS processes. Projects without a
+# package.json get an optimized copy of their files in ASSET_OUTPUT_ROOT/{job_id},
+# outside the project so gpte never sees it on /improve.
+ASSET_OPTIMIZE = os.environ.get("ASSET_OPTIMIZE", "1") != "0"
+ASSET_OUTPUT_ROOT = os.environ.get("ASSET_OUTPUT_ROOT", "/tmp/dist")
+ASSET_MINIFY = os.environ.get("ASSET_MINIFY", "1") != "0"
+ASSET_WORKERS = int(os.environ.get("ASSET_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+ASSET_POOL_MIN_FILES = int(os.environ.get("ASSET_POOL_MIN_FILES", "16"))
+ASSET_COMPRESS_MIN_BYTES = int(os.environ.get("ASSET_COMPRESS_MIN_BYTES", "1024"))
+ASSET_MINIFY_TIMEOUT = float(os.environ.get("ASSET_MINIFY_TIMEOUT", "60"))
+ASSET_EXCLUDE = ["edits/", ".gpteng/", "*.map", "*.log", ".env", ".env.*", ".DS_Store", "Thumbs.db"] + [
+    pattern.strip() for pattern in os.environ.get("ASSET_EXCLUDE", "").split(",") if pattern.strip()
+]
+
+# Workspaces: where projects are checked out and how much disk they may use in
+# total before the least recently used ones are evicted (they are restored from
+# storage on the next /build or /improve)
+WORKSPACE_ROOT = "/tmp/projects"
+WORKSPACE_MAX_BYTES = int(os.environ.get("WORKSPACE_MAX_BYTES", str(10 * 1024 ** 3)))
+# Lock files that keep the server processes on one host (uvicorn --workers) from
+# building, patching or evicting the same workspace at once
+WORKSPACE_LOCK_DIR = os.environ.get("WORKSPACE_LOCK_DIR", "/tmp/workspace-locks")
+WORKSPACE_LOCK_POLL = float(os.environ.get("WORKSPACE_LOCK_POLL", "0.5"))
+
+# Running several instances: each node has an ID and the URL other nodes can
+# reach it on, and shares job state (workspace owners, task status) through
+# JOB_STATE_URL ("memory" for a single node, or sqlite:///path/to/jobs.db)
+NODE_ID = os.environ.get("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+NODE_URL = os.environ.get("NODE_URL")
+JOB_STATE_URL = os.environ.get("JOB_STATE_URL", "memory")
+JOB_STATE_TASK_TTL = float(os.environ.get("JOB_STATE_TASK_TTL", str(7 * 24 * 3600)))
+NODE_PROXY_TIMEOUT = float(os.environ.get("NODE_PROXY_TIMEOUT", "300"))
+# How often finished tasks older than JOB_STATE_TASK_TTL are removed
+JOB_STATE_PRUNE_INTERVAL = float(os.environ.get("JOB_STATE_PRUNE_INTERVAL", "3600"))
+
+# Signed URLs: how long they are valid, how long before expiry a cached one is
+# regenerated, and how many are cached or signed in one bulk request
+SIGNED_URL_TTL = int(os.environ.get("SIGNED_URL_TTL", "3600"))
+SIGNED_URL_REFRESH_MARGIN = int(os.environ.get("SIGNED_URL_REFRESH_MARGIN", "600"))
+SIGNED_URL_MAX_ENTRIES = int(os.environ.get("SIGNED_URL_MAX_ENTRIES", "4096"))
+SIGNED_URL_BATCH = int(os.environ.get("SIGNED_URL_BATCH", "100"))
+
+# Build runner: npm and gpte run in their own process group with a reduced
+# environment, resource limits and a wall-clock timeout, and at most BUILD_SLOTS
+# of them run at once (by default half the cores)
+BUILD_SLOTS = int(os.environ.get("BUILD_SLOTS", str(max(1, (os.cpu_count() or 2) // 2))))
+BUILD_TIMEOUT = float(os.environ.get("BUILD_TIMEOUT", "900"))
+GPTE_TIMEOUT = float(os.environ.get("GPTE_TIMEOUT", "1800"))
+BUILD_CPU_SECONDS = int(os.environ.get("BUILD_CPU_SECONDS", "1200"))
+BUILD_MEMORY_BYTES = int(os.environ.get("BUILD_MEMORY_BYTES", str(4 * 1024 ** 3)))
+BUILD_NICE = int(os.environ.get("BUILD_NICE", "10"))
+BUILD_KILL_GRACE = float(os.environ.get("BUILD_KILL_GRACE", "5"))
+# Environment variables (fnmatch patterns) passed on to build processes; secrets
+# such as SUPABASE_SERVICE_ROLE_KEY are not
+BUILD_ENV_ALLOW = [
+    "PATH", "HOME", "USER", "LANG", "LC_*", "TZ", "TMPDIR", "TERM",
+    "NODE_OPTIONS", "NODE_ENV", "npm_config_*", "GPTE_*",
+    "OPENAI_*", "AZURE_OPENAI_*", "ANTHROPIC_*", "LOCAL_MODEL",
+] + [name.strip() for name in os.environ.get("BUILD_ENV_ALLOW", "").split(",") if name.strip()]
+
+# Metrics: histogram buckets (seconds) for pipeline stage and task durations
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+mimetypes.add_type("application/javascript", ".js")
+mimetypes.add_type("application/javascript", ".mjs")
+mimetypes.add_type("application/wasm", ".wasm")
+mimetypes.add_type("font/woff2", ".woff2")
+
+# Metrics
+#
+# A small Prometheus-compatible registry served at /metrics. stage() times a
+# pipeline stage into the pipeline_stage_seconds histogram and, when running
+# inside a task, appends a span to that task's record so a slow job can be
+# broken down stage by stage.
+METRICS: Dict[str, dict] = {}
+metrics_lock = threading.Lock()
+current_spans: ContextVar[Optional[list]] = ContextVar("current_spans", default=None)
+current_usage: ContextVar[Optional[list]] = ContextVar("current_usage", default=None)
+
+def define_metric(name, metric_type, help_text):
+    METRICS[name] = {"type": metric_type, "help": help_text, "samples": {}}
+
+define_metric("pipeline_stage_seconds", "histogram", "Duration of each job pipeline stage")
+define_metric("pipeline_stage_errors_total", "counter", "Pipeline stages that raised an error")
+define_metric("task_seconds", "histogram", "Duration of build and improve tasks")
+define_metric("task_queue_wait_seconds", "histogram", "Time tasks spent waiting in the queue")
+define_metric("tasks_total", "counter", "Finished build and improve tasks")
+define_metric("storage_requests_total", "counter", "Storage API calls")
+define_metric("storage_errors_total", "counter", "Storage API calls that failed after retries")
+define_metric("storage_bytes_total", "counter", "Bytes transferred to and from storage")
+define_metric("tasks_in_flight", "gauge", "Tasks currently running")
+define_metric("tasks_queued", "gauge", "Tasks waiting in the queue")
+define_metric("workspace_bytes", "gauge", "Disk used by job workspaces")
+define_metric("workspaces", "gauge", "Job workspaces on disk")
+define_metric("build_processes_total", "counter", "Finished build and gpte processes")
+define_metric("build_cpu_seconds_total", "counter", "CPU time used by build and gpte processes")
+define_metric("build_slot_wait_seconds", "histogram", "Time spent waiting for a free build slot")
+define_metric("build_slots_busy", "gauge", "Build slots in use")
+define_metric("asset_bytes_saved_total", "counter", "Bytes removed from build output by asset optimization")
+define_metric("prompt_cache_requests_total", "counter", "Prompt cache lookups for /run and /improve by result")
+define_metric("prompt_cache_evictions_total", "counter", "Prompt cache entries evicted over the size limit")
+define_metric("build_cache_requests_total", "counter", "Dependency cache lookups by result")
+define_metric("build_cache_evictions_total", "counter", "Dependency cache entries evicted over the byte budget")
+define_metric("builds_total", "counter", "Builds by whether they ran or were skipped as unchanged")
+
+def inc_counter(name, value=1, **labels):
+    key = tuple(sorted(labels.items()))
+    with metrics_lock:
+        samples = METRICS[name]["samples"]
+        samples[key] = samples.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    with metrics_lock:
+        METRICS[name]["samples"][tuple(sorted(labels.items()))] = value
+
+def observe(name, value, **labels):
+    key = tuple(sorted(labels.items()))
+    with metrics_lock:
+        samples = METRICS[name]["samples"]
+        histogram = samples.setdefault(key, {"buckets": [0] * len(METRIC_BUCKETS), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = [(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+def render_metrics():
+    """Render every metric in the Prometheus text exposition format"""
+    lines = []
+    with metrics_lock:
+        for name, metric in METRICS.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in metric["samples"].items():
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{format_labels(key)} {value}")
+                    continue
+                for bound, count in zip(METRIC_BUCKETS, value["buckets"]):
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {value['count']}")
+                lines.append(f"{name}_sum{format_labels(key)} {value['sum']}")
+                lines.append(f"{name}_count{format_labels(key)} {value['count']}")
+    return "\n".join(lines) + "\n"
 
-def run(cmd, cwd=None, env=None):
+@contextmanager
+def stage(name):
+    """Time a pipeline stage and record it as a span of the current task"""
+    started = time.monotonic()
+    wall_started = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        seconds = time.monotonic() - started
+        observe("pipeline_stage_seconds", seconds, stage=name)
+        if not ok:
+            inc_counter("pipeline_stage_errors_total", stage=name)
+        spans = current_spans.get()
+        if spans is not None:
+            spans.append({"stage": name, "start": round(wall_started, 3), "seconds": round(seconds, 4), "ok": ok})
+
+# Build runner
+#
+# Every child process (npm, gpte) goes through run_sandboxed. It waits for one of
+# BUILD_SLOTS slots, starts the command as the leader of a new session so the
+# whole tree can be signalled at once, and applies rlimits for CPU time and
+# memory (RLIMIT_DATA, which unlike RLIMIT_AS leaves V8's address space
+# reservations alone). The limits are set with prlimit right after the fork
+# rather than in preexec_fn, which is not safe in a threaded server. On timeout
+# the group gets SIGTERM, then SIGKILL after BUILD_KILL_GRACE seconds. The
+# resource usage of each process is recorded on the running task.
+build_slots = threading.BoundedSemaphore(BUILD_SLOTS)
+build_slots_busy = 0
+build_slots_lock = threading.Lock()
+
+def sandbox_env(extra=None):
+    """The allowlisted part of the server environment plus `extra`"""
+    env = {
+        name: value for name, value in os.environ.items()
+        if any(fnmatch.fnmatchcase(name, pattern) for pattern in BUILD_ENV_ALLOW)
+    }
+    env.update(extra or {})
+    return env
+
+def limit_process(pid):
+    """Apply the CPU, memory and priority limits to a freshly started process"""
+    limits = [(resource.RLIMIT_CPU, BUILD_CPU_SECONDS), (resource.RLIMIT_DATA, BUILD_MEMORY_BYTES)]
+    for limit, value in limits:
+        if value > 0:
+            try:
+                resource.prlimit(pid, limit, (value, value))
+            except (OSError, ValueError) as e:
+                print(f"Could not set resource limit {limit} on {pid}: {e}")
+    if BUILD_NICE:
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, BUILD_NICE)
+        except OSError as e:
+            print(f"Could not lower priority of {pid}: {e}")
+
+def kill_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def terminate_group(pid, timed_out, finished):
+    """Stop a process group that ran past its timeout: SIGTERM, then SIGKILL"""
+    timed_out.set()
+    print(f"Process {pid} timed out, terminating its process group")
+    kill_group(pid, signal.SIGTERM)
+    if not finished.wait(BUILD_KILL_GRACE):
+        kill_group(pid, signal.SIGKILL)
+
+def run_sandboxed(cmd, cwd=None, env=None, timeout=BUILD_TIMEOUT, on_line=None):
+    """Run a command in a build slot under resource limits and return its usage
+
+    Output lines are passed to on_line as they arrive, or collected in the
+    returned "output". The returned dict has exitCode, timedOut, cpuSeconds,
+    maxRssBytes, wallSeconds and slotWaitSeconds.
+    """
+    global build_slots_busy
+    waited = time.monotonic()
+    with build_slots:
+        slot_wait = time.monotonic() - waited
+        observe("build_slot_wait_seconds", slot_wait)
+        with build_slots_lock:
+            build_slots_busy += 1
+            set_gauge("build_slots_busy", build_slots_busy)
+        try:
+            started = time.monotonic()
+            process = subprocess.Popen(
+                cmd,
+                cwd=cwd,
+                env=sandbox_env(env),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                start_new_session=True
+            )
+            limit_process(process.pid)
+            timed_out = threading.Event()
+            finished = threading.Event()
+            timer = threading.Timer(timeout, terminate_group, (process.pid, timed_out, finished)) if timeout else None
+            if timer:
+                timer.daemon = True
+                timer.start()
+                
+            output = []
+            try:
+                for line in process.stdout:
+                    if on_line:
+                        on_line(line)
+                    else:
+                        output.append(line)
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+            finally:
+                finished.set()
+                if timer:
+                    timer.cancel()
+                process.stdout.close()
+                # Clean up anything the command left running in its group
+                kill_group(process.pid, signal.SIGKILL)
+                if process.returncode is None:
+                    process.kill()
+                    process.wait()
+        finally:
+            with build_slots_lock:
+                build_slots_busy -= 1
+                set_gauge("build_slots_busy", build_slots_busy)
+                
+    cpu_seconds = usage.ru_utime + usage.ru_stime
+    result = {
+        "command": " ".join(cmd[:3]),
+        "exitCode": process.returncode,
+        "timedOut": timed_out.is_set(),
+        "cpuSeconds": round(cpu_seconds, 3),
+        "maxRssBytes": usage.ru_maxrss * 1024,
+        "wallSeconds": round(time.monotonic() - started, 3),
+        "slotWaitSeconds": round(slot_wait, 3),
+        "output": "".join(output),
+    }
+    name = os.path.basename(cmd[0])
+    status = "timeout" if result["timedOut"] else ("success" if process.returncode == 0 else "error")
+    inc_counter("build_processes_total", command=name, status=status)
+    inc_counter("build_cpu_seconds_total", cpu_seconds, command=name)
+    usage_log = current_usage.get()
+    if usage_log is not None:
+        usage_log.append({key: value for key, value in result.items() if key != "output"})
+    return result
+
+def run(cmd, cwd=None, env=None, timeout=BUILD_TIMEOUT):
     print(f"Running: {' '.join(cmd)} in {cwd}")
-    result = subprocess.run(
-        cmd,
-        cwd=cwd,
-        env=env,
-        check=True,
-        capture_output=True,
-        text=True
-    )
-    print(f"Output: {result.stdout}")
+    result = run_sandboxed(cmd, cwd=cwd, env=env, timeout=timeout)
+    print(f"Output: {result['output']}")
+    if result["timedOut"]:
+        raise subprocess.TimeoutExpired(cmd, timeout, output=result["output"])
+    if result["exitCode"] != 0:
+        raise subprocess.CalledProcessError(result["exitCode"], cmd, output=result["output"])
     return result
 
+# Storage transfers
+#
+# Storage is reached through StorageClient, a small async client for the Supabase
+# Storage REST API on one pooled httpx.AsyncClient. It runs on the server's event
+# loop, so a slow storage call only holds up its own request. The concurrency cap
+# (STORAGE_CONCURRENCY), timeouts and keep-alive apply to every call. Code running
+# in worker threads hands its calls to the loop with run_storage, and
+# upload_files/download_files run whole batches there at once, retrying failed
+# transfers with backoff.
+#
+# Storage coroutines never use asyncio.to_thread: the threads waiting in
+# run_storage come from that same default executor, and once they fill it a
+# transfer waiting for a free thread would never finish. Their file I/O runs on
+# storage_io_executor instead, whose threads never wait on storage themselves.
+# Point SUPABASE_URL at a local fake storage server (benchmarks/fake_storage.py)
+# to exercise them in tests.
+class StorageError(Exception):
+    """An error response from the storage API; args[0] is the decoded body"""
+    def __init__(self, detail, response=None):
+        super().__init__(detail)
+        self.response = response
+
+class StorageClient:
+    """Async client for one Supabase Storage bucket"""
+    def __init__(self, url, key, bucket="game-builds"):
+        self.url = url.rstrip("/")
+        self.bucket = bucket
+        self.client = httpx.AsyncClient(
+            base_url=f"{self.url}/storage/v1",
+            headers={"Authorization": f"Bearer {key}", "apikey": key},
+            timeout=httpx.Timeout(STORAGE_TIMEOUT, connect=STORAGE_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=STORAGE_CONCURRENCY,
+                max_keepalive_connections=STORAGE_CONCURRENCY,
+                keepalive_expiry=STORAGE_KEEPALIVE_SECONDS
+            )
+        )
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        
+    def slot(self):
+        # Created lazily so it belongs to the loop the client runs on
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(STORAGE_CONCURRENCY)
+        return self.semaphore
+        
+    @staticmethod
+    def check(response):
+        if response.is_success:
+            return response
+        try:
+            detail = response.json()
+        except ValueError:
+            detail = {"statusCode": str(response.status_code), "message": response.text}
+        # Storage reports some missing objects as 400 with a 404 statusCode in the body
+        raise StorageError(detail, response)
+        
+    async def request(self, method, path, **kwargs):
+        async with self.slot():
+            return self.check(await self.client.request(method, path, **kwargs))
+            
+    async def get_bucket(self, bucket_id=None):
+        return (await self.request("GET", f"/bucket/{bucket_id or self.bucket}")).json()
+        
+    async def create_bucket(self, bucket_id=None, public=True):
+        bucket_id = bucket_id or self.bucket
+        return (await self.request("POST", "/bucket", json={"id": bucket_id, "name": bucket_id, "public": public})).json()
+        
+    async def list(self, prefix, limit=100, offset=0):
+        body = {"prefix": prefix, "limit": limit, "offset": offset, "sortBy": {"column": "name", "order": "asc"}}
+        return (await self.request("POST", f"/object/list/{self.bucket}", json=body)).json()
+        
+    async def upload(self, path, content, content_type="application/octet-stream", upsert=True):
+        """Upload bytes or an async iterator of chunks (sent chunked) to path"""
+        headers = {"content-type": content_type, "x-upsert": "true" if upsert else "false"}
+        return (await self.request("POST", f"/object/{self.bucket}/{path}", content=content, headers=headers)).json()
+        
+    async def download(self, path):
+        return (await self.request("GET", f"/object/{self.bucket}/{path}")).content
+        
+    async def download_to(self, path, file_path):
+        """Stream an object to a local file, returning the number of bytes written"""
+        written = 0
+        async with self.slot():
+            async with self.client.stream("GET", f"/object/{self.bucket}/{path}") as response:
+                if not response.is_success:
+                    await response.aread()
+                    self.check(response)
+                with open(file_path, 'wb') as f:
+                    async for chunk in response.aiter_bytes(ZIP_CHUNK_SIZE):
+                        await storage_io(f.write, chunk)
+                        written += len(chunk)
+        return written
+        
+    async def remove(self, paths):
+        return (await self.request("DELETE", f"/object/{self.bucket}", json={"prefixes": paths})).json()
+        
+    def absolute_url(self, signed_url):
+        return f"{self.url}/storage/v1{signed_url}" if signed_url else None
+        
+    async def create_signed_url(self, path, expires_in):
+        data = (await self.request("POST", f"/object/sign/{self.bucket}/{path}", json={"expiresIn": expires_in})).json()
+        data["signedURL"] = self.absolute_url(data.get("signedURL"))
+        return data
+        
+    async def create_signed_urls(self, paths, expires_in):
+        data = (await self.request("POST", f"/object/sign/{self.bucket}", json={"expiresIn": expires_in, "paths": paths})).json()
+        for item in data:
+            item["signedURL"] = self.absolute_url(item.get("signedURL"))
+        return data
+        
+    async def close(self):
+        await self.client.aclose()
+
+# Storage client if environment variables are set
+storage: Optional[StorageClient] = None
+if SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY:
+    storage = StorageClient(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+storage_io_executor = ThreadPoolExecutor(max_workers=STORAGE_IO_THREADS, thread_name_prefix="storage-io")
+
+async def storage_io(fn, *args):
+    """Run blocking file I/O for a storage transfer without using the default executor"""
+    return await asyncio.get_running_loop().run_in_executor(storage_io_executor, fn, *args)
+
+def run_storage(coro, timeout=STORAGE_CALL_TIMEOUT):
+    """Run a storage coroutine on the event loop from a worker thread and wait for it"""
+    if event_loop is None:
+        coro.close()
+        raise RuntimeError("Storage is not available before the server has started")
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is event_loop:
+        coro.close()
+        raise RuntimeError("run_storage would block the event loop; await the storage call instead")
+    future = asyncio.run_coroutine_threadsafe(coro, event_loop)
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        future.cancel()
+        raise TimeoutError(f"Storage call did not finish within {timeout:.0f}s")
+
+def guess_content_type(file_path):
+    """Determine the content type based on the file extension"""
+    content_type = "text/plain"
+    if file_path.endswith(".html"):
+        content_type = "text/html"
+    elif file_path.endswith(".js"):
+        content_type = "application/javascript"
+    elif file_path.endswith(".css"):
+        content_type = "text/css"
+    elif file_path.endswith(".json"):
+        content_type = "application/json"
+    return content_type
+
+def walk_project(proj_dir):
+    """Yield (absolute path, path relative to the project) for every file in a project"""
+    for root, _, files in os.walk(proj_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+            yield file_path, os.path.relpath(file_path, proj_dir)
+
+def is_not_found(e):
+    """Whether a storage error means the object does not exist (not worth retrying)"""
+    response = getattr(e, "response", None)
+    if getattr(response, "status_code", None) == 404:
+        return True
+    detail = e.args[0] if e.args else None
+    return isinstance(detail, dict) and str(detail.get("statusCode")) == "404"
+
+async def with_retries(description, fn, *args, **kwargs):
+    """Await fn(...), retrying with exponential backoff and jitter if it raises"""
+    delay = STORAGE_RETRY_BACKOFF
+    for attempt in range(1, STORAGE_RETRIES + 1):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == STORAGE_RETRIES or is_not_found(e):
+                raise
+            print(f"{description} failed (attempt {attempt}/{STORAGE_RETRIES}): {e}; retrying in {delay:.1f}s")
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            delay *= 2
+
+async def storage_request(op, description, fn, *args, **kwargs):
+    """Make a storage API call with retries, counting it (and any failure) in the metrics"""
+    inc_counter("storage_requests_total", op=op)
+    try:
+        return await with_retries(description, fn, *args, **kwargs)
+    except Exception:
+        inc_counter("storage_errors_total", op=op)
+        raise
+
+def storage_call(op, description, fn, *args, **kwargs):
+    """storage_request for code running in worker threads"""
+    return run_storage(storage_request(op, description, fn, *args, **kwargs))
+
+def read_bytes(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+def write_bytes(file_path, data):
+    # Ensure the directory exists
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as f:
+        f.write(data)
+
+async def upload_one(file_path, storage_path):
+    """Upload a single local file, returning the number of bytes sent"""
+    file_data = await storage_io(read_bytes, file_path)
+    await storage_request(
+        "upload",
+        f"Upload of {storage_path}",
+        storage.upload,
+        storage_path,
+        file_data,
+        guess_content_type(file_path)
+    )
+    inc_counter("storage_bytes_total", len(file_data), direction="upload")
+    return len(file_data)
+
+async def download_one(storage_path, file_path):
+    """Download a single object to a local file, returning the number of bytes received"""
+    response = await storage_request("download", f"Download of {storage_path}", storage.download, storage_path)
+    inc_counter("storage_bytes_total", len(response), direction="download")
+    await storage_io(write_bytes, file_path, response)
+    return len(response)
+
+async def transfer_batch_async(label, fn, items, failed=None):
+    stats = {"files": 0, "failed": 0, "bytes": 0, "seconds": 0.0, "bytesPerSecond": 0.0}
+    started = time.monotonic()
+    results = await asyncio.gather(*(fn(*item) for item in items), return_exceptions=True)
+    for item, result in zip(items, results):
+        if isinstance(result, BaseException):
+            print(f"Error in {label} for {item}: {result}")
+            stats["failed"] += 1
+            if failed is not None:
+                failed.append(item)
+        else:
+            stats["bytes"] += result
+            stats["files"] += 1
+            
+    stats["seconds"] = round(time.monotonic() - started, 3)
+    if stats["seconds"] > 0:
+        stats["bytesPerSecond"] = round(stats["bytes"] / stats["seconds"], 1)
+    print(
+        f"{label}: {stats['files']} files, {stats['bytes']} bytes in {stats['seconds']}s "
+        f"({stats['bytesPerSecond']} B/s, {stats['failed']} failed)"
+    )
+    return stats
+
+def transfer_batch(label, fn, items, failed=None):
+    """Run fn(*item) for every item concurrently on the storage client and report the batch throughput
+
+    Items that still fail after retries are appended to `failed` when it is given.
+    """
+    if not storage:
+        print(f"WARNING: Supabase client not initialized - skipping {label}")
+        if failed is not None:
+            failed.extend(items)
+        return {"files": 0, "failed": len(items), "bytes": 0, "seconds": 0.0, "bytesPerSecond": 0.0}
+    return run_storage(transfer_batch_async(label, fn, items, failed))
+
+def upload_files(items, label="upload", failed=None):
+    """Upload (local path, storage path) pairs concurrently"""
+    return transfer_batch(label, upload_one, items, failed)
+
+def download_files(items, label="download", failed=None):
+    """Download (storage path, local path) pairs concurrently"""
+    return transfer_batch(label, download_one, items, failed)
+
+async def list_tree_async(prefix, label):
+    entries = []
+    offset = 0
+    while True:
+        page = await storage_request(
+            "list", f"{label} ({prefix}, offset {offset})", storage.list, prefix, STORAGE_LIST_PAGE_SIZE, offset
+        )
+        entries.extend(page)
+        if len(page) < STORAGE_LIST_PAGE_SIZE:
+            break
+        offset += len(page)
+        
+    # Entries without an id are folders
+    files = [entry for entry in entries if entry.get("id") is not None]
+    folders = [entry["name"] for entry in entries if entry.get("id") is None]
+    for folder, nested in zip(folders, await asyncio.gather(*(list_tree_async(f"{prefix}/{name}", label) for name in folders))):
+        files.extend({**entry, "name": f"{folder}/{entry['name']}"} for entry in nested)
+    return files
+
+def list_tree(prefix, label="list"):
+    """List every object under a storage prefix, following pages and nested folders
+
+    Entry names are relative to the prefix (e.g. "src/game.js").
+    """
+    return run_storage(list_tree_async(prefix.rstrip("/"), label))
+
+def remove_objects(paths, label="remove"):
+    """Delete storage objects in batches, returning how many were removed"""
+    removed = 0
+    for i in range(0, len(paths), 100):
+        batch = paths[i:i + 100]
+        try:
+            storage_call("remove", f"{label} ({len(batch)} objects)", storage.remove, batch)
+            removed += len(batch)
+        except Exception as e:
+            print(f"Error in {label}: {e}")
+    return removed
+
+# Content-addressed incremental sync
+#
+# Each project keeps a manifest with the sha256 of every synced file and the
+# signature of every edit that has been pulled. It lives in MANIFEST_ROOT rather
+# than the project directory, and a copy is stored next to the project files in
+# storage as MANIFEST_NAME. sync_project only uploads files whose
+# hash changed and removes files that were deleted; pull_edits skips edits whose
+# signature matches one that has already been applied.
+def matches_patterns(rel_path, patterns):
+    """Check a project-relative path against fnmatch patterns (a trailing "/" matches a directory)"""
+    parts = rel_path.replace(os.sep, "/").split("/")
+    for pattern in patterns:
+        if pattern.endswith("/"):
+            if any(fnmatch.fnmatch(part, pattern[:-1]) for part in parts[:-1]):
+                return True
+        elif fnmatch.fnmatch(parts[-1], pattern) or fnmatch.fnmatch("/".join(parts), pattern):
+            return True
+    return False
+
+def is_ignored(rel_path):
+    """Check a project-relative path against the SYNC_IGNORE rules"""
+    return matches_patterns(rel_path, SYNC_IGNORE)
+
+def hash_file(file_path):
+    """Return the sha256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def manifest_path(proj_dir):
+    """Local path of a project's sync manifest, keyed on its job ID"""
+    return os.path.join(MANIFEST_ROOT, f"{os.path.basename(os.path.normpath(proj_dir))}.json")
+
+def load_manifest(proj_dir):
+    """Load the project's sync manifest, or an empty one"""
+    try:
+        with open(manifest_path(proj_dir)) as f:
+            manifest = json.load(f)
+        manifest.setdefault("files", {})
+        manifest.setdefault("edits", {})
+        return manifest
+    except FileNotFoundError:
+        return {"version": 1, "files": {}, "edits": {}}
+    except Exception as e:
+        print(f"Ignoring unreadable manifest in {proj_dir}: {e}")
+        return {"version": 1, "files": {}, "edits": {}}
+
+def save_manifest(proj_dir, manifest):
+    """Atomically write the project's sync manifest"""
+    path = manifest_path(proj_dir)
+    os.makedirs(MANIFEST_ROOT, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(tmp_path, path)
+    return path
+
+def scan_project(proj_dir, previous=None):
+    """Hash every non-ignored file in a project
+
+    Files whose size and mtime match the previous manifest entry reuse its hash.
+    """
+    previous = previous or {}
+    files = {}
+    for file_path, rel_path in walk_project(proj_dir):
+        rel_path = rel_path.replace(os.sep, "/")
+        if is_ignored(rel_path):
+            continue
+        stat = os.stat(file_path)
+        entry = previous.get(rel_path)
+        if entry and entry.get("size") == stat.st_size and entry.get("mtimeNs") == stat.st_mtime_ns:
+            files[rel_path] = entry
+        else:
+            files[rel_path] = {"sha256": hash_file(file_path), "size": stat.st_size, "mtimeNs": stat.st_mtime_ns}
+    return files
+
+def load_remote_manifest(job_id, proj_dir):
+    """Fetch the manifest stored next to the project files, if there is one"""
+    try:
+        run_storage(download_one(f"projects/{job_id}/{MANIFEST_NAME}", manifest_path(proj_dir)))
+        print(f"Using stored manifest for job {job_id}")
+    except Exception as e:
+        print(f"No stored manifest for job {job_id}: {e}")
+    return load_manifest(proj_dir)
+
+@stage("storage_sync")
+def sync_project(job_id, proj_dir, label=None):
+    """Upload new and changed project files, remove deleted ones and store the manifest"""
+    label = label or f"Sync project {job_id}"
+    proj_storage_path = f"projects/{job_id}"
+    stats = {"uploaded": 0, "removed": 0, "unchanged": 0, "failed": 0, "bytes": 0}
+    if not storage:
+        print(f"WARNING: Supabase client not initialized - skipping {label}")
+        return stats
+        
+    manifest = load_manifest(proj_dir)
+    if not manifest["files"] and not os.path.exists(manifest_path(proj_dir)):
+        manifest = load_remote_manifest(job_id, proj_dir)
+        
+    previous = manifest["files"]
+    current = scan_project(proj_dir, previous)
+    
+    changed = [rel for rel, entry in current.items() if previous.get(rel, {}).get("sha256") != entry["sha256"]]
+    deleted = [rel for rel in previous if rel not in current]
+    stats["unchanged"] = len(current) - len(changed)
+    
+    failed = []
+    upload_stats = upload_files(
+        [(os.path.join(proj_dir, rel), f"{proj_storage_path}/{rel}") for rel in changed],
+        label,
+        failed
+    )
+    stats["uploaded"] = upload_stats["files"]
+    stats["failed"] = upload_stats["failed"]
+    stats["bytes"] = upload_stats["bytes"]
+    
+    # Files that failed to upload keep their old entry so they are retried next time
+    for file_path, _ in failed:
+        rel = os.path.relpath(file_path, proj_dir).replace(os.sep, "/")
+        if rel in previous:
+            current[rel] = previous[rel]
+        else:
+            current.pop(rel, None)
+            
+    if deleted:
+        stats["removed"] = remove_objects([f"{proj_storage_path}/{rel}" for rel in deleted], f"{label} (deletions)")
+        
+    manifest["files"] = current
+    local_manifest = save_manifest(proj_dir, manifest)
+    try:
+        run_storage(upload_one(local_manifest, f"{proj_storage_path}/{MANIFEST_NAME}"))
+    except Exception as e:
+        print(f"Error uploading manifest for job {job_id}: {e}")
+        
+    print(
+        f"{label}: {stats['uploaded']} uploaded, {stats['removed']} removed, "
+        f"{stats['unchanged']} unchanged, {stats['failed']} failed"
+    )
+    mark_workspace_synced(job_id, stats["failed"] == 0)
+    return stats
+
+def dir_size(path):
+    """Total size in bytes of the files under a directory"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return total
+
+# Dependency cache
+#
+# npm install is keyed on the hash of package.json plus the lockfile. On a hit the
+# prepared node_modules tree is hardlinked into the project (falling back to a
+# copy across filesystems); on a miss we install against the shared offline npm
+# cache and then add the result to the cache.
+build_cache_lock = threading.Lock()
+BUILD_CACHE_STATS = {
+    "hits": 0,
+    "misses": 0,
+    "reused": 0,
+    "evictions": 0,
+    "installs": 0,
+    "installSeconds": 0.0,
+    "lastInstallSeconds": None,
+    "linkSeconds": 0.0,
+}
+BUILD_CACHE_MARKER = ".build-cache-key"
+
+def dependency_key(proj):
+    """Hash package.json and whichever lockfiles exist"""
+    digest = hashlib.sha256()
+    for name in ["package.json"] + LOCKFILES:
+        path = os.path.join(proj, name)
+        if os.path.exists(path):
+            digest.update(name.encode())
+            digest.update(hash_file(path).encode())
+    return digest.hexdigest()
+
+def link_or_copy(src, dst):
+    """Hardlink a file, copying it if linking is not possible"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def link_tree(src, dst):
+    """Recreate a directory tree using hardlinks"""
+    shutil.copytree(src, dst, symlinks=True, copy_function=link_or_copy)
+
+def read_cache_marker(node_modules):
+    try:
+        with open(os.path.join(node_modules, BUILD_CACHE_MARKER)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def write_cache_marker(node_modules, key):
+    with open(os.path.join(node_modules, BUILD_CACHE_MARKER), "w") as f:
+        f.write(key)
+
+def cache_entry_size(path):
+    """Size of a node_modules cache entry, as recorded when it was created"""
+    try:
+        with open(os.path.join(path, ".size")) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return dir_size(path)
+
+def evict_build_cache(keep=None):
+    """Remove least recently used node_modules entries until the cache fits its budget"""
+    entries = []
+    for name in os.listdir(NODE_MODULES_CACHE_DIR):
+        path = os.path.join(NODE_MODULES_CACHE_DIR, name)
+        if not os.path.isdir(path) or ".tmp-" in name:
+            continue
+        entries.append((os.stat(path).st_mtime, cache_entry_size(path), name, path))
+        
+    total = sum(size for _, size, _, _ in entries)
+    for _, size, name, path in sorted(entries):
+        if total <= BUILD_CACHE_MAX_BYTES:
+            break
+        if name == keep:
+            continue
+        print(f"Evicting dependency cache entry {path} ({size} bytes)")
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        BUILD_CACHE_STATS["evictions"] += 1
+        inc_counter("build_cache_evictions_total")
+
+@stage("npm_install")
+def install_dependencies(proj):
+    """Provide node_modules for a project, reusing the dependency cache when possible"""
+    os.makedirs(NODE_MODULES_CACHE_DIR, exist_ok=True)
+    os.makedirs(NPM_CACHE_DIR, exist_ok=True)
+    
+    key = dependency_key(proj)
+    entry = os.path.join(NODE_MODULES_CACHE_DIR, key)
+    node_modules = os.path.join(proj, "node_modules")
+    
+    # Dependencies are unchanged since the last build of this project
+    if read_cache_marker(node_modules) == key:
+        BUILD_CACHE_STATS["reused"] += 1
+        inc_counter("build_cache_requests_total", result="reused")
+        print(f"Dependencies unchanged for {proj}, reusing node_modules")
+        return {"cache": "reused", "key": key, "seconds": 0.0}
+        
+    started = time.monotonic()
+    with build_cache_lock:
+        if os.path.isdir(os.path.join(entry, "node_modules")):
+            shutil.rmtree(node_modules, ignore_errors=True)
+            link_tree(os.path.join(entry, "node_modules"), node_modules)
+            write_cache_marker(node_modules, key)
+            os.utime(entry)
+            seconds = round(time.monotonic() - started, 3)
+            BUILD_CACHE_STATS["hits"] += 1
+            inc_counter("build_cache_requests_total", result="hit")
+            BUILD_CACHE_STATS["linkSeconds"] += seconds
+            print(f"Dependency cache hit for {proj} ({key[:12]}), linked in {seconds}s")
+            return {"cache": "hit", "key": key, "seconds": seconds}
+            
+    # Cache miss: a node_modules linked from another entry must not be modified in place
+    BUILD_CACHE_STATS["misses"] += 1
+    inc_counter("build_cache_requests_total", result="miss")
+    if read_cache_marker(node_modules):
+        shutil.rmtree(node_modules, ignore_errors=True)
+        
+    env = {"npm_config_cache": NPM_CACHE_DIR}
+    has_lockfile = os.path.exists(os.path.join(proj, "package-lock.json")) or os.path.exists(os.path.join(proj, "npm-shrinkwrap.json"))
+    flags = ["--prefer-offline", "--no-audit", "--no-fund"]
+    if has_lockfile:
+        try:
+            run(["npm", "ci"] + flags, cwd=proj, env=env)
+        except subprocess.CalledProcessError:
+            # npm ci refuses a lockfile that no longer matches package.json (e.g. after
+            # gpte added a dependency); npm install resolves it and updates the lockfile
+            print(f"npm ci failed for {proj}, falling back to npm install")
+            shutil.rmtree(node_modules, ignore_errors=True)
+            run(["npm", "install"] + flags, cwd=proj, env=env)
+            key = dependency_key(proj)
+            entry = os.path.join(NODE_MODULES_CACHE_DIR, key)
+    else:
+        run(["npm", "install"] + flags, cwd=proj, env=env)
+    
+    seconds = round(time.monotonic() - started, 3)
+    BUILD_CACHE_STATS["installs"] += 1
+    BUILD_CACHE_STATS["installSeconds"] += seconds
+    BUILD_CACHE_STATS["lastInstallSeconds"] = seconds
+    print(f"Dependency cache miss for {proj} ({key[:12]}), installed in {seconds}s")
+    
+    # Add the fresh install to the cache
+    if os.path.isdir(node_modules):
+        with build_cache_lock:
+            try:
+                if not os.path.isdir(entry):
+                    tmp_entry = f"{entry}.tmp-{uuid.uuid4().hex}"
+                    link_tree(node_modules, os.path.join(tmp_entry, "node_modules"))
+                    with open(os.path.join(tmp_entry, ".size"), "w") as f:
+                        f.write(str(dir_size(tmp_entry)))
+                    os.rename(tmp_entry, entry)
+                write_cache_marker(node_modules, key)
+                evict_build_cache(keep=key)
+            except Exception as e:
+                print(f"Could not add dependencies to the cache: {e}")
+                traceback.print_exc()
+                
+    return {"cache": "miss", "key": key, "seconds": seconds}
+
+# Streaming zip archives
+#
+# iter_zip yields a zip archive of a directory in chunks of about ZIP_CHUNK_SIZE,
+# so archives can be uploaded or sent to a client without ever being fully in
+# memory or written to /tmp. Entries use data descriptors because the output
+# is not seekable.
+class ZipChunkSink:
+    """Write-only, non-seekable file object that collects zip output until it is taken"""
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+        
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        return len(data)
+        
+    def tell(self):
+        return self.offset
+        
+    def seek(self, *args):
+        raise OSError("ZipChunkSink is not seekable")
+        
+    def flush(self):
+        pass
+        
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def zip_compress_type(rel_path):
+    """Store already-compressed assets as is and deflate everything else"""
+    if os.path.splitext(rel_path)[1].lower() in PRECOMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def iter_zip(src_dir, exclude=None):
+    """Yield a zip archive of src_dir in chunks, skipping paths for which exclude(rel_path) is true"""
+    sink = ZipChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for file_path, rel_path in walk_project(src_dir):
+            if exclude and exclude(rel_path):
+                continue
+            zinfo = zipfile.ZipInfo.from_file(file_path, rel_path, strict_timestamps=False)
+            zinfo.compress_type = zip_compress_type(rel_path)
+            with open(file_path, 'rb') as src, zf.open(zinfo, 'w', force_zip64=zinfo.file_size > 2 ** 31) as dest:
+                for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b""):
+                    dest.write(chunk)
+                    if len(sink.buffer) >= ZIP_CHUNK_SIZE:
+                        yield sink.take()
+            if sink.buffer:
+                yield sink.take()
+    # Closing the archive writes the central directory
+    yield sink.take()
+
+class IterReader(io.RawIOBase):
+    """Readable file object over an iterator of byte chunks"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b"")
+        self.bytes_read = 0
+        
+    def readable(self):
+        return True
+        
+    def readinto(self, buffer):
+        while not self.pending:
+            try:
+                self.pending = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        self.bytes_read += size
+        return size
+
+async def iter_in_thread(chunks):
+    """Async iterator over a blocking iterator, advancing it on the storage I/O threads"""
+    chunks = iter(chunks)
+    while True:
+        chunk = await storage_io(next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+def iter_file(file_path):
+    with open(file_path, 'rb') as f:
+        yield from iter(lambda: f.read(ZIP_CHUNK_SIZE), b"")
+
+def upload_stream(make_chunks, storage_path, content_type="application/zip"):
+    """Upload the bytes produced by make_chunks() without buffering them, returning the size
+
+    make_chunks is called again for every retry, since a stream can only be read once.
+    """
+    async def attempt():
+        size = 0
+        async def counted():
+            nonlocal size
+            async for chunk in iter_in_thread(make_chunks()):
+                size += len(chunk)
+                yield chunk
+        await storage.upload(storage_path, counted(), content_type)
+        return size
+    size = storage_call("upload", f"Streaming upload of {storage_path}", attempt)
+    inc_counter("storage_bytes_total", size, direction="upload")
+    return size
+
+def download_to_file(storage_path, file_path):
+    """Stream an object from storage straight to disk, returning the number of bytes written"""
+    size = storage_call("download", f"Download of {storage_path}", storage.download_to, storage_path, file_path)
+    inc_counter("storage_bytes_total", size, direction="download")
+    return size
+
+# Job logs
+#
+# Log positions are byte offsets into build.log. Each job has a JobLog holding the
+# most recent lines in a ring buffer; the worker thread appends to it while gpte
+# runs and wakes up every stream subscriber on the event loop. Subscribers that
+# fall behind the buffer catch up from the file by seeking to their offset.
+#
+# Once build.log reaches LOG_ROTATE_BYTES it is moved to build.log.segments/ as
+# {start}-{end}.log and gzipped in the background, and a new build.log continues
+# at offset {end}. Offsets therefore keep counting across rotations: the current
+# file starts where the last segment ends. Reads walk the segments in order and
+# tails read the current file backwards from its end, so a poll costs about as
+# much as the lines it returns (plus at most one segment for old offsets).
+event_loop: Optional[asyncio.AbstractEventLoop] = None
+JOB_LOGS: "OrderedDict[str, JobLog]" = OrderedDict()
+job_logs_lock = threading.Lock()
+LOG_SEGMENT_NAME = re.compile(r'(\d+)-(\d+)\.log(\.gz)?')
+LOG_TAIL_BLOCK = 64 * 1024
+
+def job_log_path(job_id):
+    return f"/tmp/projects/{job_id}/build.log"
+
+def log_segments_dir(log_file_path):
+    return f"{log_file_path}.segments"
+
+def log_sources(log_file_path):
+    """The parts of a log in order as (start offset, end offset or None, path), ending with the current file"""
+    segments = {}
+    try:
+        names = os.listdir(log_segments_dir(log_file_path))
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        match = LOG_SEGMENT_NAME.fullmatch(name)
+        if match:
+            # While a segment is being compressed both copies can exist; they hold the same lines
+            segments[(int(match.group(1)), int(match.group(2)))] = os.path.join(log_segments_dir(log_file_path), name)
+    sources = [(start, end, path) for (start, end), path in sorted(segments.items())]
+    base = sources[-1][1] if sources else 0
+    return sources + [(base, None, log_file_path)]
+
+def log_size(log_file_path):
+    """Offset just after the last byte written to a log"""
+    base = log_sources(log_file_path)[-1][0]
+    return base + (os.path.getsize(log_file_path) if os.path.exists(log_file_path) else 0)
+
+def log_exists(log_file_path):
+    return os.path.exists(log_file_path) or os.path.isdir(log_segments_dir(log_file_path))
+
+def open_log_source(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+def read_log_consistently(log_file_path, read):
+    """Call read(sources), retrying if the log was rotated while it ran"""
+    for attempt in range(3):
+        sources = log_sources(log_file_path)
+        try:
+            result = read(sources)
+        except FileNotFoundError:
+            # A segment was compressed or dropped under us
+            if attempt == 2:
+                raise
+            continue
+        if log_sources(log_file_path)[-1][0] == sources[-1][0] or attempt == 2:
+            return result
+
+def read_log_lines(log_file_path, offset=0, limit=None):
+    """Read up to `limit` lines starting at a byte offset, as (start, end, line) tuples
+
+    Offsets before the oldest segment still kept start at that segment.
+    """
+    def read(sources):
+        lines = []
+        position = max(offset, sources[0][0])
+        for start, end, path in sources:
+            if (end is not None and position >= end) or (limit is not None and len(lines) >= limit):
+                continue
+            if end is None and not os.path.exists(path):
+                break
+            with open_log_source(path) as log_file:
+                log_file.seek(position - start)
+                while limit is None or len(lines) < limit:
+                    raw = log_file.readline()
+                    if not raw:
+                        break
+                    lines.append((position, position + len(raw), raw.decode("utf-8", errors="replace")))
+                    position += len(raw)
+        return lines
+    return read_log_consistently(log_file_path, read)
+
+def tail_log_source(start, path, count):
+    """The last `count` lines of one log file as (start, end, line) tuples"""
+    if path.endswith(".gz"):
+        # Compressed segments can only be read forwards
+        lines = deque(maxlen=count)
+        with gzip.open(path, "rb") as log_file:
+            for raw in log_file:
+                lines.append((start, start + len(raw), raw.decode("utf-8", errors="replace")))
+                start += len(raw)
+        return list(lines)
+        
+    with open(path, "rb") as log_file:
+        end = position = log_file.seek(0, os.SEEK_END)
+        data = b""
+        # Read blocks backwards until there are more line breaks than lines wanted
+        while position > 0 and data.count(b"\n") <= count:
+            step = min(LOG_TAIL_BLOCK, position)
+            position -= step
+            log_file.seek(position)
+            data = log_file.read(step) + data
+    raws = data.split(b"\n")
+    raws = [raw + b"\n" for raw in raws[:-1]] + ([raws[-1]] if raws[-1] else [])
+    if position > 0:
+        raws = raws[1:]  # starts mid-line
+    raws = raws[-count:]
+    offset = start + end - sum(len(raw) for raw in raws)
+    lines = []
+    for raw in raws:
+        lines.append((offset, offset + len(raw), raw.decode("utf-8", errors="replace")))
+        offset += len(raw)
+    return lines
+
+def tail_log_lines(log_file_path, count):
+    """The last `count` lines of a log, reading backwards from the end (and into segments if needed)"""
+    def read(sources):
+        lines = deque()
+        for start, end, path in reversed(sources):
+            if len(lines) >= count:
+                break
+            if end is None and not os.path.exists(path):
+                continue
+            lines.extendleft(reversed(tail_log_source(start, path, count - len(lines))))
+        return list(lines)
+    return read_log_consistently(log_file_path, read)
+
+def compress_log_segment(segment_path):
+    """Gzip a rotated log segment and drop the oldest segments beyond LOG_KEEP_SEGMENTS"""
+    try:
+        with open(segment_path, "rb") as src, gzip.open(segment_path + ".gz.tmp", "wb") as dest:
+            shutil.copyfileobj(src, dest, ZIP_CHUNK_SIZE)
+        os.replace(segment_path + ".gz.tmp", segment_path + ".gz")
+        os.remove(segment_path)
+        
+        segments_dir = os.path.dirname(segment_path)
+        names = sorted(name for name in os.listdir(segments_dir) if LOG_SEGMENT_NAME.fullmatch(name))
+        ranges = sorted({LOG_SEGMENT_NAME.fullmatch(name).group(1, 2) for name in names}, key=lambda r: int(r[0]))
+        dropped = {f"{start}-{end}" for start, end in ranges[:-LOG_KEEP_SEGMENTS]}
+        for name in names:
+            if name.split(".")[0] in dropped:
+                os.remove(os.path.join(segments_dir, name))
+    except Exception as e:
+        print(f"Error compressing log segment {segment_path}: {e}")
+
+class JobLog:
+    """Append-only build.log for one job with an in-memory tail and live subscribers"""
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.path = job_log_path(job_id)
+        self.lines = deque(maxlen=LOG_BUFFER_LINES)
+        self.lock = threading.Lock()
+        self.waiters = set()
+        self.file = None
+        self.base = 0
+        self.size = log_size(self.path)
+        
+    @property
+    def active(self):
+        return self.file is not None
+        
+    def open(self):
+        with self.lock:
+            self.file = open(self.path, "ab")
+            self.base = log_sources(self.path)[-1][0]
+            self.size = self.base + self.file.tell()
+            # Anything in the buffer from before may not match the file any more
+            if self.lines and self.lines[-1][1] != self.size:
+                self.lines.clear()
+        return self
+        
+    def write(self, line):
+        data = line.encode("utf-8")
+        with self.lock:
+            if self.size - self.base >= LOG_ROTATE_BYTES:
+                self.rotate()
+            self.file.write(data)
+            self.file.flush()  # Ensure immediate write to disk
+            self.lines.append((self.size, self.size + len(data), line))
+            self.size += len(data)
+        self.notify()
+        
+    def rotate(self):
+        """Move the current file into a segment (compressed in the background) and start a new one"""
+        self.file.close()
+        segments_dir = log_segments_dir(self.path)
+        os.makedirs(segments_dir, exist_ok=True)
+        segment_path = os.path.join(segments_dir, f"{self.base:020d}-{self.size:020d}.log")
+        os.replace(self.path, segment_path)
+        self.file = open(self.path, "ab")
+        self.base = self.size
+        threading.Thread(target=compress_log_segment, args=(segment_path,), daemon=True).start()
+        
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+        self.notify()
+        
+    def __enter__(self):
+        return self.open()
+        
+    def __exit__(self, *exc):
+        self.close()
+        
+    def notify(self):
+        """Wake up every subscriber waiting on the event loop"""
+        if event_loop is None:
+            return
+        for waiter in list(self.waiters):
+            event_loop.call_soon_threadsafe(waiter.set)
+            
+    def current_size(self):
+        with self.lock:
+            if self.file is None:
+                self.size = log_size(self.path)
+            return self.size
+            
+    def buffered_since(self, offset):
+        """Lines after `offset` from the ring buffer, or None if the buffer no longer reaches back that far"""
+        with self.lock:
+            if not self.lines or offset < self.lines[0][0]:
+                return [] if offset >= self.size else None
+            return [entry for entry in self.lines if entry[0] >= offset]
+
+def get_job_log(job_id):
+    """Return the JobLog for a job, creating it if needed"""
+    with job_logs_lock:
+        log = JOB_LOGS.get(job_id)
+        if log is None:
+            log = JOB_LOGS[job_id] = JobLog(job_id)
+        JOB_LOGS.move_to_end(job_id)
+        
+        # Drop the buffers of the least recently used idle jobs
+        for other_id in list(JOB_LOGS)[:max(0, len(JOB_LOGS) - LOG_BUFFER_JOBS)]:
+            if not JOB_LOGS[other_id].active and not JOB_LOGS[other_id].waiters:
+                del JOB_LOGS[other_id]
+        return log
+
+async def stream_job_log(job_id, offset, follow=True):
+    """Yield build.log as Server-Sent Events starting at a byte offset
+
+    Each event's id is the offset just after its line, so a client can resume with
+    Last-Event-ID. The stream ends once the log is idle and fully sent.
+    """
+    log = get_job_log(job_id)
+    while True:
+        waiter = asyncio.Event()
+        log.waiters.add(waiter)
+        try:
+            lines = log.buffered_since(offset)
+            if lines is None:
+                lines = await asyncio.to_thread(read_log_lines, log.path, offset, LOG_PAGE_LINES)
+            for _, end, line in lines:
+                text = line.rstrip("\r\n")
+                yield f"id: {end}\ndata: {text}\n\n"
+                offset = end
+            if lines:
+                continue
+            if not follow or (not log.active and not job_has_active_task(job_id) and offset >= log.current_size()):
+                yield f"id: {offset}\nevent: end\ndata: \n\n"
+                return
+            try:
+                await asyncio.wait_for(waiter.wait(), LOG_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+        finally:
+            log.waiters.discard(waiter)
+
+# Prompt/result cache
+#
+# Results are keyed on the normalized prompt plus, for /improve, a hash of the
+# project snapshot the prompt was run against. An improve result is stored as the
+# files it changed (content-addressed blobs under PROMPT_CACHE_DIR) and the files
+# it deleted, so it can be replayed onto any project with the same snapshot.
+# Identical requests that are still in flight are coalesced instead of cached.
+PROMPT_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+prompt_cache_lock = threading.Lock()
+PROMPT_CACHE_STATS = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+
+def normalize_prompt(prompt):
+    """Fold case, unicode forms and whitespace so near-identical prompts share a key"""
+    return " ".join(unicodedata.normalize("NFKC", prompt).casefold().split())
+
+def snapshot_hash(files):
+    """Hash a project snapshot from its manifest entries"""
+    digest = hashlib.sha256()
+    for rel in sorted(files):
+        digest.update(f"{rel}\0{files[rel]['sha256']}\n".encode())
+    return digest.hexdigest()
+
+def prompt_cache_key(kind, prompt, snapshot=""):
+    return hashlib.sha256(f"{kind}\0{normalize_prompt(prompt)}\0{snapshot}".encode()).hexdigest()
+
+def remove_unreferenced_blobs(entry):
+    """Delete the blobs of an evicted improve result that no other entry uses"""
+    referenced = {sha for other in PROMPT_CACHE.values() for sha in other.get("files", {}).values()}
+    for sha in set(entry.get("files", {}).values()) - referenced:
+        try:
+            os.remove(os.path.join(PROMPT_CACHE_DIR, "blobs", sha))
+        except OSError:
+            pass
+
+def prompt_cache_get(key):
+    """Return a live cache entry, dropping it if it has expired"""
+    with prompt_cache_lock:
+        entry = PROMPT_CACHE.get(key)
+        if entry is None:
+            return None
+        if entry["expiresAt"] < time.time():
+            del PROMPT_CACHE[key]
+            remove_unreferenced_blobs(entry)
+            return None
+        PROMPT_CACHE.move_to_end(key)
+        return entry
+
+def prompt_cache_put(key, entry, ttl):
+    """Store a cache entry and evict the least recently used ones over the size limit"""
+    entry["createdAt"] = time.time()
+    entry["expiresAt"] = entry["createdAt"] + ttl
+    with prompt_cache_lock:
+        PROMPT_CACHE[key] = entry
+        PROMPT_CACHE.move_to_end(key)
+        while len(PROMPT_CACHE) > PROMPT_CACHE_MAX_ENTRIES:
+            _, evicted = PROMPT_CACHE.popitem(last=False)
+            remove_unreferenced_blobs(evicted)
+            PROMPT_CACHE_STATS["evictions"] += 1
+            inc_counter("prompt_cache_evictions_total")
+
+def store_improve_result(key, proj_dir, before, after):
+    """Cache the files an improve changed and deleted, as content-addressed blobs"""
+    blob_dir = os.path.join(PROMPT_CACHE_DIR, "blobs")
+    os.makedirs(blob_dir, exist_ok=True)
+    changed = {rel: entry["sha256"] for rel, entry in after.items() if before.get(rel, {}).get("sha256") != entry["sha256"]}
+    for rel, sha in changed.items():
+        blob_path = os.path.join(blob_dir, sha)
+        if not os.path.exists(blob_path):
+            tmp_path = f"{blob_path}.tmp-{uuid.uuid4().hex}"
+            shutil.copyfile(os.path.join(proj_dir, rel), tmp_path)
+            os.replace(tmp_path, blob_path)
+        else:
+            # A blob is kept as long as the newest entry that uses it
+            os.utime(blob_path)
+    prompt_cache_put(key, {
+        "kind": "improve",
+        "files": changed,
+        "deleted": [rel for rel in before if rel not in after],
+        "snapshot": snapshot_hash(after),
+    }, PROMPT_CACHE_TTL)
+
+def remove_stale_blobs():
+    """Delete blobs older than PROMPT_CACHE_TTL, returning how many were removed
+
+    Cache entries live in memory, so blobs left by an earlier run (or by another
+    server process sharing PROMPT_CACHE_DIR) are only removed here. No live entry
+    can use a blob older than the TTL, since reusing a blob refreshes its mtime.
+    """
+    blob_dir = os.path.join(PROMPT_CACHE_DIR, "blobs")
+    if not os.path.isdir(blob_dir):
+        return 0
+    cutoff = time.time() - PROMPT_CACHE_TTL
+    removed = 0
+    for name in os.listdir(blob_dir):
+        path = os.path.join(blob_dir, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        print(f"Removed {removed} stale prompt cache blobs")
+    return removed
+
+async def sweep_prompt_cache():
+    """Remove stale prompt cache blobs every PROMPT_CACHE_SWEEP_INTERVAL seconds"""
+    while True:
+        try:
+            await asyncio.to_thread(remove_stale_blobs)
+        except Exception as e:
+            print(f"Could not sweep prompt cache blobs: {e}")
+        await asyncio.sleep(PROMPT_CACHE_SWEEP_INTERVAL)
+
+def apply_improve_result(entry, proj_dir):
+    """Replay a cached improve result onto a project; False if its blobs are gone"""
+    blob_dir = os.path.join(PROMPT_CACHE_DIR, "blobs")
+    if not all(os.path.exists(os.path.join(blob_dir, sha)) for sha in entry["files"].values()):
+        return False
+    for rel, sha in entry["files"].items():
+        dest = os.path.join(proj_dir, rel)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(os.path.join(blob_dir, sha), dest)
+    for rel in entry["deleted"]:
+        try:
+            os.remove(os.path.join(proj_dir, rel))
+        except FileNotFoundError:
+            pass
+    return True
+
+def edit_version(edit_file):
+    """The version of an edit recorded in the manifest, from its storage listing entry"""
+    metadata = edit_file.get('metadata') or {}
+    return {"etag": metadata.get('eTag'), "updatedAt": edit_file.get('updated_at')}
+
+def edit_is_applied(recorded, edit_file):
+    """Whether the recorded version of an edit is at least as new as the listed one"""
+    if not recorded:
+        return False
+    current = edit_version(edit_file)
+    if isinstance(recorded, str):
+        # Manifests written before versions were recorded hold a single signature
+        return recorded in (current["etag"], current["updatedAt"])
+    if current["etag"] and recorded.get("etag"):
+        return current["etag"] == recorded["etag"]
+    return bool(current["updatedAt"]) and current["updatedAt"] <= (recorded.get("updatedAt") or "")
+
+@stage("pull_edits")
 def pull_edits(job_id, project_dir):
-    """Pull edits from Supabase storage into the project directory"""
-    if not supabase:
+    """Pull new and updated edits from Supabase storage into the project directory
+
+    Returns a summary of what was listed, applied, skipped and failed.
+    """
+    summary = {"listed": 0, "applied": 0, "skipped": 0, "failed": 0, "bytes": 0, "seconds": 0.0, "files": []}
+    if not storage:
         print("WARNING: Supabase client not initialized - cannot pull edits")
-        return
+        return summary
     
     try:
         # Create edits directory if it doesn't exist
         edits_dir = os.path.join(project_dir, "edits")
         os.makedirs(edits_dir, exist_ok=True)
         
-        # List all edits for the job
-        edit_files = supabase.storage.from_('game-builds').list(f"edits/{job_id}")
+        # List all edits for the job, across pages and folders
+        edit_files = list_tree(f"edits/{job_id}", f"List edits for {job_id}")
+        summary["listed"] = len(edit_files)
         
+        # Skip edits that were already applied and are still on disk
+        manifest = load_manifest(project_dir)
+        pending = []
         for edit_file in edit_files:
-            file_path = edit_file['name']
-            
-            # Download the edit file
-            response = supabase.storage.from_('game-builds').download(f"edits/{job_id}/{file_path}")
-            
-            # Ensure the directory exists
-            os.makedirs(os.path.dirname(os.path.join(project_dir, file_path)), exist_ok=True)
+            file_path = safe_join(project_dir, edit_file['name'])
+            if not file_path or is_ignored(edit_file['name']):
+                print(f"Ignoring edit to {edit_file['name']}: outside the project or not synced")
+                summary["skipped"] += 1
+                continue
+            if edit_is_applied(manifest["edits"].get(edit_file['name']), edit_file) and os.path.exists(file_path):
+                summary["skipped"] += 1
+                continue
+            pending.append((edit_file, file_path))
             
-            # Write the file
-            with open(os.path.join(project_dir, file_path), 'wb') as f:
-                f.write(response)
+        # Download the remaining edit files into the project
+        failed = []
+        stats = download_files(
+            [(f"edits/{job_id}/{edit_file['name']}", file_path) for edit_file, file_path in pending],
+            f"Pull edits for {job_id}",
+            failed
+        )
+        
+        failed_paths = {storage_path for storage_path, _ in failed}
+        for edit_file, _ in pending:
+            if f"edits/{job_id}/{edit_file['name']}" not in failed_paths:
+                manifest["edits"][edit_file['name']] = edit_version(edit_file)
+                summary["files"].append(edit_file['name'])
                 
-        print(f"Successfully pulled {len(edit_files)} edits for job {job_id}")
+        # Replay patches logged since the snapshots (or since the last pull)
+        summary["patches"] = replay_patches(job_id, project_dir, manifest, set(summary["files"]))
+        save_manifest(project_dir, manifest)
+        
+        summary.update(applied=stats["files"], failed=stats["failed"], bytes=stats["bytes"], seconds=stats["seconds"])
+        # Keep the response small for long edit histories
+        summary["files"] = sorted(summary["files"])[:100]
+        print(
+            f"Pulled edits for job {job_id}: {summary['applied']} applied, {summary['skipped']} already applied, "
+            f"{summary['failed']} failed ({summary['listed']} listed)"
+        )
     except Exception as e:
         print(f"Error pulling edits: {e}")
         traceback.print_exc()
+        summary["error"] = str(e)
+    return summary
+
+SIGNED_URLS: "OrderedDict[str, tuple]" = OrderedDict()
+signed_urls_lock = threading.Lock()
+SIGNED_URL_STATS = {"hits": 0, "misses": 0, "refreshed": 0, "requests": 0}
+
+def signed_url_result(item):
+    """Pull the URL out of a create_signed_url(s) response entry"""
+    if not item or item.get("error"):
+        return None
+    return item.get("signedURL") or item.get("signedUrl")
+
+def sign_storage_paths(storage_paths):
+    """Return signed URLs for several objects, reusing cached ones until close to expiry
+
+    Paths that are missing or about to expire are signed together with the bulk
+    API, along with any other cached URLs that are due for renewal, so a burst of
+    requests costs one round trip instead of one per path.
+    """
+    now = time.time()
+    urls = {}
+    with signed_urls_lock:
+        for path in storage_paths:
+            cached = SIGNED_URLS.get(path)
+            if cached and cached[1] - SIGNED_URL_REFRESH_MARGIN > now:
+                SIGNED_URLS.move_to_end(path)
+                SIGNED_URL_STATS["hits"] += 1
+                urls[path] = cached[0]
+        missing = [path for path in dict.fromkeys(storage_paths) if path not in urls]
+        if not missing:
+            return urls
+        SIGNED_URL_STATS["misses"] += len(missing)
+        due = [
+            path for path, (_, expires_at) in SIGNED_URLS.items()
+            if expires_at - SIGNED_URL_REFRESH_MARGIN <= now and path not in missing
+        ]
+        batch = missing + due[:max(0, SIGNED_URL_BATCH - len(missing))]
+
+    for i in range(0, len(batch), SIGNED_URL_BATCH):
+        chunk = batch[i:i + SIGNED_URL_BATCH]
+        expires_at = time.time() + SIGNED_URL_TTL
+        with stage("sign_url"):
+            if len(chunk) == 1:
+                results = [storage_call(
+                    "sign",
+                    f"Signing {chunk[0]}",
+                    storage.create_signed_url,
+                    chunk[0],
+                    SIGNED_URL_TTL
+                )]
+            else:
+                results = storage_call(
+                    "sign",
+                    f"Signing {len(chunk)} paths",
+                    storage.create_signed_urls,
+                    chunk,
+                    SIGNED_URL_TTL
+                )
+        with signed_urls_lock:
+            SIGNED_URL_STATS["requests"] += 1
+            for path, item in zip(chunk, results):
+                url = signed_url_result(item)
+                if not url:
+                    print(f"Failed to create signed URL for {path}: {item}")
+                    SIGNED_URLS.pop(path, None)
+                    continue
+                if path not in missing:
+                    SIGNED_URL_STATS["refreshed"] += 1
+                SIGNED_URLS[path] = (url, expires_at)
+                SIGNED_URLS.move_to_end(path)
+                if path in missing:
+                    urls[path] = url
+            while len(SIGNED_URLS) > SIGNED_URL_MAX_ENTRIES:
+                SIGNED_URLS.popitem(last=False)
+    return urls
+
+def sign_storage_path(storage_path):
+    """Return a signed URL for an object in storage, cached until close to expiry"""
+    signed_url = sign_storage_paths([storage_path]).get(storage_path)
+    if not signed_url:
+        print("Failed to create signed URL")
+    return signed_url
 
 def upload_to_supabase(file_path, storage_path, content_type="application/zip"):
     """Upload a file to Supabase storage and return a signed URL"""
-    if not supabase:
+    if not storage:
         print("WARNING: Supabase client not initialized - cannot upload file")
         return None
     
@@ -93,42 +1787,41 @@ def upload_to_supabase(file_path, storage_path, content_type="application/zip"):
             print(f"File not found: {file_path}")
             return None
             
-        # Upload the file
-        with open(file_path, 'rb') as f:
-            file_data = f.read()
+        # Upload the file, streaming it from disk
+        with stage("storage_upload"):
+            size = upload_stream(lambda: iter_file(file_path), storage_path, content_type)
+        print(f"Uploaded {size} bytes to {storage_path}")
             
-            # Upload to storage
-            result = supabase.storage.from_('game-builds').upload(
-                path=storage_path,
-                file=file_data,
-                file_options={"content-type": content_type, "upsert": "true"}
-            )
+        return sign_storage_path(storage_path)
             
-            print(f"Upload result: {result}")
-            
-        # Create a signed URL
-        signed_url_result = supabase.storage.from_('game-builds').create_signed_url(
-            path=storage_path,
-            expires_in=3600  # 1 hour expiry
-        )
+    except Exception as e:
+        print(f"Error uploading or signing file: {e}")
+        traceback.print_exc()
+        return None
+
+def upload_archive_to_supabase(src_dir, storage_path, exclude=None):
+    """Stream a zip of a directory to Supabase storage and return a signed URL"""
+    if not storage:
+        print("WARNING: Supabase client not initialized - cannot upload archive")
+        return None
         
-        print(f"Signed URL result: {signed_url_result}")
+    try:
+        print(f"Streaming archive of {src_dir} to Supabase at {storage_path}")
+        with stage("archive_upload"):
+            size = upload_stream(lambda: iter_zip(src_dir, exclude), storage_path)
+        print(f"Uploaded {size} byte archive to {storage_path}")
+        
+        return sign_storage_path(storage_path)
         
-        if "signedURL" in signed_url_result:
-            return signed_url_result["signedURL"]
-        else:
-            print("Failed to create signed URL")
-            return None
-            
     except Exception as e:
-        print(f"Error uploading or signing file: {e}")
+        print(f"Error uploading or signing archive: {e}")
         traceback.print_exc()
         return None
 
 def upload_and_sign(file_path, storage_path):
     """Upload a file to Supabase storage using a different method"""
     try:
-        # Make sure the bucket exists first
+        # Make sure the bucket exists first (memoized after the startup check)
         ensure_bucket_exists()
         
         return upload_to_supabase(file_path, storage_path)
@@ -136,29 +1829,225 @@ def upload_and_sign(file_path, storage_path):
         print(f"Error in upload_and_sign: {e}")
         traceback.print_exc()
         return None
+
+def upload_archive_and_sign(src_dir, storage_path, exclude=None):
+    """Archive a directory straight into Supabase storage and return a signed URL"""
+    try:
+        # Make sure the bucket exists first (memoized after the startup check)
+        ensure_bucket_exists()
+        
+        return upload_archive_to_supabase(src_dir, storage_path, exclude)
+    except Exception as e:
+        print(f"Error in upload_archive_and_sign: {e}")
+        traceback.print_exc()
+        return None
         
+bucket_ready = False
+bucket_lock = threading.Lock()
+
 def ensure_bucket_exists():
-    """Make sure the game-builds bucket exists in Supabase storage"""
-    if not supabase:
+    """Make sure the game-builds bucket exists in Supabase storage
+
+    The check runs once at startup; later calls return the memoized result and
+    only go to storage again if that first check failed.
+    """
+    global bucket_ready
+    if not storage:
         print("WARNING: Supabase client not initialized - cannot create bucket")
         return False
+    if bucket_ready:
+        return True
         
-    try:
+    with bucket_lock:
+        if bucket_ready:
+            return True
         try:
-            # Try to list the bucket to see if it exists
-            supabase.storage.get_bucket('game-builds')
-            print("Bucket 'game-builds' already exists")
+            try:
+                # Try to list the bucket to see if it exists
+                inc_counter("storage_requests_total", op="bucket")
+                run_storage(storage.get_bucket())
+                print("Bucket 'game-builds' already exists")
+            except Exception as e:
+                print(f"Bucket 'game-builds' does not exist or error: {e}")
+                
+                # Create the bucket
+                inc_counter("storage_requests_total", op="bucket")
+                run_storage(storage.create_bucket(public=True))
+                print("Created bucket 'game-builds'")
+            bucket_ready = True
             return True
         except Exception as e:
-            print(f"Bucket 'game-builds' does not exist or error: {e}")
+            print(f"Error creating bucket: {e}")
+            traceback.print_exc()
+            return False
+
+# Project scaffolding
+#
+# /run renders the starter files from templates compiled once at import, zips
+# them in memory and uploads the files, their manifest and the zip in one
+# concurrent batch. Nothing touches the disk: the project stays in
+# PENDING_SCAFFOLDS until something needs the workspace, and materialize_scaffold
+# writes it out then. Without storage (or if the upload fails) the project is
+# written to disk right away, since it would otherwise only exist in memory.
+SCAFFOLD_TEMPLATES = {
+    "main.js": string.Template("""// Generated game based on prompt: $prompt
+console.log("Game starting...");
+document.body.innerHTML = '<h1>Generated Game</h1><div id="game"></div>';
+const gameDiv = document.getElementById("game");
+gameDiv.innerHTML = '<p>This is a simple game based on your prompt: $prompt</p>';
+"""),
+    "index.html": string.Template("""<!DOCTYPE html>
+<html>
+<head>
+    <title>Generated Game</title>
+    <style>
+        body { font-family: sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; }
+        #game { border: 1px solid #ccc; padding: 20px; margin-top: 20px; }
+    </style>
+</head>
+<body>
+    <h1>Game</h1>
+    <div id="game"></div>
+    <script src="main.js"></script>
+</body>
+</html>
+"""),
+}
+PENDING_SCAFFOLDS: "OrderedDict[str, dict]" = OrderedDict()
+pending_scaffolds_lock = threading.Lock()
+
+def render_scaffold(prompt):
+    """Render the starter project files for a prompt"""
+    return {name: template.substitute(prompt=prompt).encode() for name, template in SCAFFOLD_TEMPLATES.items()}
+
+def zip_files(files):
+    """Build a zip of in-memory files"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+    return buffer.getvalue()
+
+def scaffold_manifest(files):
+    """The sync manifest for in-memory files (mtimes are filled in once written)"""
+    return {
+        "version": 1,
+        "files": {name: {"sha256": hashlib.sha256(data).hexdigest(), "size": len(data), "mtimeNs": None} for name, data in files.items()},
+        "edits": {},
+    }
+
+def write_scaffold(proj, files, manifest):
+    """Write scaffold files and their manifest into a project directory"""
+    for name, data in files.items():
+        write_bytes(os.path.join(proj, name), data)
+        manifest["files"][name]["mtimeNs"] = os.stat(os.path.join(proj, name)).st_mtime_ns
+    save_manifest(proj, manifest)
+
+def materialize_scaffold(job_id):
+    """Write a pending scaffold to its workspace; True if there was one"""
+    with pending_scaffolds_lock:
+        scaffold = PENDING_SCAFFOLDS.get(job_id)
+        if scaffold is None:
+            return False
+        proj = f"{WORKSPACE_ROOT}/{job_id}"
+        os.makedirs(proj, exist_ok=True)
+        write_scaffold(proj, scaffold["files"], scaffold["manifest"])
+        del PENDING_SCAFFOLDS[job_id]
+    refresh_workspace(job_id)
+    mark_workspace_synced(job_id, True)
+    print(f"Wrote pending scaffold for job {job_id} to disk")
+    return True
+
+async def upload_data(data, storage_path, content_type):
+    """Upload bytes held in memory, returning the number of bytes sent"""
+    await storage_request("upload", f"Upload of {storage_path}", storage.upload, storage_path, data, content_type)
+    inc_counter("storage_bytes_total", len(data), direction="upload")
+    return len(data)
+
+async def create_project(prompt):
+    """Generate a new project from the prompt and store it"""
+    job_id = str(uuid.uuid4())
+    proj = f"/tmp/projects/{job_id}"
+    
+    # Generate a simple game based on the prompt
+    with stage("generate"):
+        files = render_scaffold(prompt)
+        manifest = scaffold_manifest(files)
+        archive = zip_files(files)
+        
+    # Store in Supabase if available
+    proj_storage_path = f"projects/{job_id}"
+    zip_storage_path = f"{job_id}.zip"
+    download_url = f"/download/{job_id}"
+    uploaded = False
+    
+    if storage:
+        try:
+            # Make sure the bucket exists first (memoized after the startup check)
+            await asyncio.to_thread(ensure_bucket_exists)
             
-            # Create the bucket
-            supabase.storage.create_bucket('game-builds', {'public': True})
-            print("Created bucket 'game-builds'")
-            return True
+            # Upload the project files (for later editing), their manifest and the zip together
+            print(f"Saving project files to Supabase storage: {proj_storage_path}")
+            items = [(data, f"{proj_storage_path}/{name}", guess_content_type(name)) for name, data in files.items()]
+            items.append((json.dumps(manifest, sort_keys=True).encode(), f"{proj_storage_path}/{MANIFEST_NAME}", "application/json"))
+            items.append((archive, zip_storage_path, "application/zip"))
+            with stage("storage_upload"):
+                stats = await transfer_batch_async(f"Upload project {job_id}", upload_data, items)
+            uploaded = stats["failed"] == 0
+            
+            signed_url = await asyncio.to_thread(sign_storage_path, zip_storage_path) if uploaded else None
+            if signed_url:
+                download_url = signed_url
+                print(f"Uploaded to Supabase with signed URL: {download_url}")
+            else:
+                print("Failed to upload to Supabase, using local file fallback")
+        except Exception as e:
+            print(f"Error uploading to Supabase: {e}")
+            # Continue with local file if Supabase upload fails
+            
+    if uploaded:
+        with pending_scaffolds_lock:
+            PENDING_SCAFFOLDS[job_id] = {"files": files, "manifest": manifest, "zip": archive, "snapshot": snapshot_hash(manifest["files"])}
+            while len(PENDING_SCAFFOLDS) > PENDING_SCAFFOLDS_MAX:
+                # Already in storage, so it can be restored from there when needed
+                PENDING_SCAFFOLDS.popitem(last=False)
+        await asyncio.to_thread(claim_workspace, job_id)
+    else:
+        await asyncio.to_thread(os.makedirs, proj, exist_ok=True)
+        await asyncio.to_thread(write_scaffold, proj, files, manifest)
+        print(f"Created project directory: {proj}")
+    
+    return {
+        "jobId": job_id,
+        "download": download_url
+    }
+
+RUN_INFLIGHT: Dict[str, asyncio.Future] = {}
+
+def project_snapshot(job_id):
+    """Snapshot hash of a project, pending or on disk; None if it is neither"""
+    with pending_scaffolds_lock:
+        scaffold = PENDING_SCAFFOLDS.get(job_id)
+        if scaffold:
+            return scaffold["snapshot"]
+    proj = f"/tmp/projects/{job_id}"
+    if not os.path.isdir(proj):
+        return None
+    return snapshot_hash(scan_project(proj, load_manifest(proj)["files"]))
+
+def project_unchanged(job_id, snapshot):
+    """Whether a project still matches a snapshot hash and has no edits waiting in storage"""
+    if project_snapshot(job_id) != snapshot:
+        return False
+    if not storage:
+        return True
+    # The editor writes edits straight to storage without touching the workspace
+    try:
+        return not list_tree(f"edits/{job_id}", f"List edits for {job_id}") and not list_tree(
+            f"patches/{job_id}", f"List patches for {job_id}"
+        )
     except Exception as e:
-        print(f"Error creating bucket: {e}")
-        traceback.print_exc()
+        print(f"Could not check edits of job {job_id}: {e}")
         return False
 
 @app.post("/run")
@@ -170,107 +2059,678 @@ async def run_gpt_engineer(request: Request):
         if not prompt:
             raise HTTPException(status_code=400, detail="Prompt is required")
             
-        job_id = str(uuid.uuid4())
-        proj = f"/tmp/projects/{job_id}"
+        # Retries of one client request (same Idempotency-Key header or requestId) reuse
+        # its project while that project is untouched; without a key every call gets
+        # a new project, so the same prompt from different callers never shares one
+        idempotency_key = request.headers.get("idempotency-key") or data.get("requestId")
+        if not idempotency_key:
+            PROMPT_CACHE_STATS["misses"] += 1
+            inc_counter("prompt_cache_requests_total", kind="run", result="miss")
+            result = await create_project(prompt)
+            await asyncio.to_thread(refresh_workspace, result["jobId"])
+            await enforce_workspace_budget()
+            return {**result, "cache": "miss"}
+            
+        key = prompt_cache_key("run", prompt, idempotency_key)
+        cached = prompt_cache_get(key)
+        if cached and await asyncio.to_thread(project_unchanged, cached["result"]["jobId"], cached["snapshot"]):
+            PROMPT_CACHE_STATS["hits"] += 1
+            inc_counter("prompt_cache_requests_total", kind="run", result="hit")
+            print(f"Prompt cache hit for /run, reusing job {cached['result']['jobId']}")
+            return {**cached["result"], "cache": "hit"}
+            
+        # Coalesce onto the same request that is still running
+        if key in RUN_INFLIGHT:
+            PROMPT_CACHE_STATS["coalesced"] += 1
+            inc_counter("prompt_cache_requests_total", kind="run", result="coalesced")
+            return {**await asyncio.shield(RUN_INFLIGHT[key]), "cache": "coalesced"}
+            
+        PROMPT_CACHE_STATS["misses"] += 1
+        inc_counter("prompt_cache_requests_total", kind="run", result="miss")
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.exception())
+        RUN_INFLIGHT[key] = future
+        try:
+            result = await create_project(prompt)
+            await asyncio.to_thread(refresh_workspace, result["jobId"])
+            await enforce_workspace_budget()
+            snapshot = await asyncio.to_thread(project_snapshot, result["jobId"])
+            prompt_cache_put(key, {"kind": "run", "result": result, "snapshot": snapshot}, PROMPT_CACHE_RUN_TTL)
+            future.set_result(result)
+        except BaseException as e:
+            # Also resolve on cancellation so coalesced waiters never hang on the future
+            if isinstance(e, Exception):
+                future.set_exception(e)
+            else:
+                future.set_exception(RuntimeError("The original request for this project was cancelled"))
+            raise
+        finally:
+            del RUN_INFLIGHT[key]
+            
+        return {**result, "cache": "miss"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error in /run: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Workspace lifecycle
+#
+# Every job's checkout under WORKSPACE_ROOT is tracked with its disk footprint
+# (including the job's archives in /tmp) and the time it was last used. When
+# the total goes over WORKSPACE_MAX_BYTES the coldest workspaces that are fully
+# synced to storage and not in use are deleted; ensure_workspace restores them
+# from storage the next time a build or improve needs them.
+WORKSPACES: Dict[str, dict] = {}
+workspaces_lock = threading.Lock()
+WORKSPACE_STATS = {"evictions": 0, "evictedBytes": 0, "rehydrations": 0}
+
+def workspace_paths(job_id):
+    """The project directory, archives, optimized output and manifest that make up a job's footprint"""
+    return [
+        f"{WORKSPACE_ROOT}/{job_id}", f"/tmp/{job_id}.zip", f"/tmp/{job_id}-dist.zip",
+        f"{ASSET_OUTPUT_ROOT}/{job_id}", manifest_path(job_id),
+    ]
+
+def touch_workspace(job_id):
+    """Record that a workspace was just used"""
+    with workspaces_lock:
+        workspace = WORKSPACES.get(job_id)
+        if workspace:
+            workspace["lastAccess"] = time.time()
+
+def mark_workspace_synced(job_id, synced):
+    """Record whether everything in a workspace is also in storage"""
+    with workspaces_lock:
+        workspace = WORKSPACES.setdefault(job_id, {"bytes": 0, "lastAccess": time.time(), "synced": False})
+        workspace["synced"] = synced
+
+def refresh_workspace(job_id):
+    """Measure a workspace's footprint after it changed"""
+    proj = f"{WORKSPACE_ROOT}/{job_id}"
+    if not os.path.isdir(proj):
+        with workspaces_lock:
+            WORKSPACES.pop(job_id, None)
+        return
         
-        os.makedirs(proj, exist_ok=True)
+    size = sum(
+        dir_size(path) if os.path.isdir(path) else os.path.getsize(path)
+        for path in workspace_paths(job_id) if os.path.exists(path)
+    )
+    with workspaces_lock:
+        workspace = WORKSPACES.setdefault(job_id, {"bytes": 0, "lastAccess": time.time(), "synced": False})
+        workspace["bytes"] = size
+        workspace["lastAccess"] = time.time()
+        claim = not workspace.get("claimed")
+        workspace["claimed"] = True
+    if claim:
+        claim_workspace(job_id)
+
+def workspace_matches_manifest(proj):
+    """Whether every file in a workspace has the hash its manifest says was uploaded
+
+    Failed uploads keep their old manifest entry and an interrupted improve leaves
+    changed files behind, so either makes the workspace differ from its manifest.
+    """
+    manifest = load_manifest(proj)
+    if not manifest["files"]:
+        return False
+    current = scan_project(proj, manifest["files"])
+    return {rel: entry["sha256"] for rel, entry in current.items()} == {
+        rel: entry.get("sha256") for rel, entry in manifest["files"].items()
+    }
+
+def load_workspaces():
+    """Register the workspaces already on disk (at startup)"""
+    if not os.path.isdir(WORKSPACE_ROOT):
+        return
+    for job_id in os.listdir(WORKSPACE_ROOT):
+        proj = f"{WORKSPACE_ROOT}/{job_id}"
+        if not os.path.isdir(proj):
+            continue
+        # Older versions kept the manifest inside the project
+        legacy_manifest = os.path.join(proj, MANIFEST_NAME)
+        if os.path.exists(legacy_manifest):
+            os.makedirs(MANIFEST_ROOT, exist_ok=True)
+            os.replace(legacy_manifest, manifest_path(proj))
+        refresh_workspace(job_id)
+        with workspaces_lock:
+            WORKSPACES[job_id]["lastAccess"] = os.stat(proj).st_mtime
+        # Only a workspace known to be in storage may be evicted
+        synced = workspace_matches_manifest(proj)
+        with workspaces_lock:
+            WORKSPACES[job_id]["synced"] = synced
+    print(f"Found {len(WORKSPACES)} existing workspaces ({workspace_stats()['bytes']} bytes)")
+
+def workspace_stats():
+    with workspaces_lock:
+        return {
+            "count": len(WORKSPACES),
+            "bytes": sum(workspace["bytes"] for workspace in WORKSPACES.values()),
+            "budget": WORKSPACE_MAX_BYTES,
+            **WORKSPACE_STATS,
+        }
+
+def try_lock_workspace(job_id):
+    """Take the host-wide lock on a job's workspace without waiting
+
+    Returns the open lock file, or None if another process holds the lock.
+    """
+    os.makedirs(WORKSPACE_LOCK_DIR, exist_ok=True)
+    lock_file = open(os.path.join(WORKSPACE_LOCK_DIR, f"{job_id}.lock"), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+def unlock_workspace(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+@asynccontextmanager
+async def workspace_lock(job_id, timeout=None):
+    """Hold a job's project lock in this process and its lock file on this host
+
+    Server processes on one host share WORKSPACE_ROOT but not project_locks, so
+    builds, improves, patches and eviction also take the lock file. Raises
+    asyncio.TimeoutError if both are not acquired within `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    lock = project_locks.setdefault(job_id, asyncio.Lock())
+    if timeout == 0:
+        # Only take the lock if it is free right now
+        if lock.locked():
+            raise asyncio.TimeoutError()
+        await lock.acquire()
+    else:
+        await asyncio.wait_for(lock.acquire(), timeout)
+    try:
+        # Poll rather than block so waiting does not hold a thread
+        while (lock_file := await asyncio.to_thread(try_lock_workspace, job_id)) is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise asyncio.TimeoutError()
+            await asyncio.sleep(WORKSPACE_LOCK_POLL)
+        try:
+            yield
+        finally:
+            unlock_workspace(lock_file)
+    finally:
+        lock.release()
+
+def evict_workspace(job_id):
+    """Delete a workspace from disk, returning the bytes freed"""
+    with workspaces_lock:
+        workspace = WORKSPACES.pop(job_id, None)
+    freed = workspace["bytes"] if workspace else 0
+    release_workspace(job_id)
+    for path in workspace_paths(job_id):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    with job_logs_lock:
+        log = JOB_LOGS.get(job_id)
+        if log and not log.active:
+            del JOB_LOGS[job_id]
+    WORKSPACE_STATS["evictions"] += 1
+    WORKSPACE_STATS["evictedBytes"] += freed
+    print(f"Evicted workspace {job_id} ({freed} bytes)")
+    return freed
+
+async def enforce_workspace_budget():
+    """Evict least recently used workspaces until the total fits WORKSPACE_MAX_BYTES"""
+    # Without storage an evicted workspace could never be restored
+    if not storage:
+        return
         
-        print(f"Created project directory: {proj}")
+    with workspaces_lock:
+        total = sum(workspace["bytes"] for workspace in WORKSPACES.values())
+        candidates = sorted(WORKSPACES, key=lambda job_id: WORKSPACES[job_id]["lastAccess"])
         
-        # Generate a simple game based on the prompt
-        with open(f"{proj}/main.js", "w") as f:
-            f.write(f"""// Generated game based on prompt: {prompt}
-console.log("Game starting...");
-document.body.innerHTML = '<h1>Generated Game</h1><div id="game"></div>';
-const gameDiv = document.getElementById("game");
-gameDiv.innerHTML = '<p>This is a simple game based on your prompt: {prompt}</p>';
-""")
+    for job_id in candidates:
+        if total <= WORKSPACE_MAX_BYTES:
+            break
+        workspace = WORKSPACES.get(job_id)
+        if not workspace or not workspace["synced"] or job_has_active_task(job_id):
+            continue
+        lock = project_locks.setdefault(job_id, asyncio.Lock())
+        if lock.locked():
+            continue
+        async with lock:
+            log = JOB_LOGS.get(job_id)
+            if job_has_active_task(job_id) or (log and log.active):
+                continue
+            # Another server process on this host may be using it
+            lock_file = try_lock_workspace(job_id)
+            if lock_file is None:
+                continue
+            try:
+                total -= await asyncio.to_thread(evict_workspace, job_id)
+            finally:
+                unlock_workspace(lock_file)
+
+@stage("restore_workspace")
+def restore_workspace(job_id, proj):
+    """Download a project from storage into an empty workspace; True if anything was restored"""
+    # The manifest stored next to the project files lists every synced file
+    try:
+        run_storage(download_one(f"projects/{job_id}/{MANIFEST_NAME}", manifest_path(proj)))
+        files = load_manifest(proj)["files"]
+        stats = download_files(
+            [(f"projects/{job_id}/{rel}", os.path.join(proj, rel)) for rel in files],
+            f"Restore project {job_id}"
+        )
+        if files and not stats["failed"]:
+            print(f"Restored project files for job {job_id} from its manifest")
+            return True
+    except Exception as e:
+        print(f"No stored manifest for job {job_id}: {e}")
+        
+    # Otherwise fall back to the original zip, then to the individual project files
+    try:
+        # Save zip file
+        zip_path = f"/tmp/{job_id}.zip"
+        download_to_file(f"{job_id}.zip", zip_path)
             
-        with open(f"{proj}/index.html", "w") as f:
-            f.write(f"""<!DOCTYPE html>
-<html>
-<head>
-    <title>Generated Game</title>
-    <style>
-        body {{ font-family: sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; }}
-        #game {{ border: 1px solid #ccc; padding: 20px; margin-top: 20px; }}
-    </style>
-</head>
-<body>
-    <h1>Game</h1>
-    <div id="game"></div>
-    <script src="main.js"></script>
-</body>
-</html>
-""")
-            
-        # Create a zip file
-        zip_file = shutil.make_archive(f"/tmp/{job_id}", 'zip', proj)
-        print(f"Created zip file: {zip_file}")
-        
-        # Make sure we also save the entire project to Supabase storage
-        proj_storage_path = f"projects/{job_id}"
-        print(f"Saving project files to Supabase storage: {proj_storage_path}")
-        
-        # Upload individual project files to storage for later editing
-        for root, _, files in os.walk(proj):
-            for file in files:
-                file_path = os.path.join(root, file)
-                rel_path = os.path.relpath(file_path, proj)
-                storage_path = f"{proj_storage_path}/{rel_path}"
+        # Extract zip
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            zip_ref.extractall(proj)
+            
+        print(f"Downloaded and extracted from Supabase storage for job {job_id}")
+        return True
+    except Exception as zip_e:
+        print(f"Could not download zip from Supabase: {zip_e}")
+        
+    # If zip doesn't exist, try to download individual files from projects folder
+    try:
+        project_files = list_tree(f"projects/{job_id}", f"List project {job_id}")
+        
+        stats = download_files(
+            [
+                (f"projects/{job_id}/{file_obj['name']}", os.path.join(proj, file_obj['name']))
+                for file_obj in project_files if file_obj['name'] != MANIFEST_NAME
+            ],
+            f"Download project {job_id}"
+        )
                 
-                # Determine content type based on file extension
-                content_type = "text/plain"
-                if file.endswith(".html"):
-                    content_type = "text/html"
-                elif file.endswith(".js"):
-                    content_type = "application/javascript"
-                elif file.endswith(".css"):
-                    content_type = "text/css"
-                elif file.endswith(".json"):
-                    content_type = "application/json"
-                    
-                try:
-                    with open(file_path, 'rb') as f:
-                        file_data = f.read()
-                        if supabase:
-                            result = supabase.storage.from_('game-builds').upload(
-                                path=storage_path,
-                                file=file_data,
-                                file_options={"content-type": content_type, "upsert": "true"}
-                            )
-                            print(f"Uploaded {storage_path} to storage: {result}")
-                except Exception as e:
-                    print(f"Error uploading {storage_path}: {e}")
-        
-        # Store in Supabase if available
-        zip_storage_path = f"{job_id}.zip"
-        download_url = f"/download/{job_id}"
-        
-        if supabase:
+        print(f"Downloaded individual project files from Supabase storage for job {job_id}")
+        return stats["files"] > 0
+    except Exception as proj_e:
+        print(f"Could not download project files from Supabase: {proj_e}")
+        return False
+
+def ensure_workspace(job_id):
+    """Return the job's project directory, restoring it from storage if it is not on disk"""
+    proj = f"{WORKSPACE_ROOT}/{job_id}"
+    if materialize_scaffold(job_id):
+        return proj
+    if os.path.isdir(proj) and os.listdir(proj):
+        touch_workspace(job_id)
+        return proj
+        
+    if not storage:
+        raise FileNotFoundError("Project directory not found")
+        
+    os.makedirs(proj, exist_ok=True)
+    if not restore_workspace(job_id, proj):
+        shutil.rmtree(proj, ignore_errors=True)
+        raise FileNotFoundError(f"Project {job_id} not found in storage")
+        
+    WORKSPACE_STATS["rehydrations"] += 1
+    refresh_workspace(job_id)
+    mark_workspace_synced(job_id, True)
+    # The stored project files do not include later edits and patches
+    pull_edits(job_id, proj)
+    print(f"Rehydrated workspace for job {job_id}")
+    return proj
+
+def build_fingerprint(proj, manifest):
+    """Hash the source tree and the pulled edits that a build of the project depends on"""
+    files = scan_project(proj, manifest["files"])
+    digest = hashlib.sha256(snapshot_hash(files).encode())
+    for name in sorted(manifest["edits"]):
+        digest.update(f"{name}\0{json.dumps(manifest['edits'][name], sort_keys=True)}\n".encode())
+    if ASSET_OPTIMIZE:
+        # The optimized output also depends on what the optimizer can do
+        digest.update(f"assets\0{ASSET_MINIFY}\0{bool(brotli)}\0{bool(shutil.which('esbuild'))}\n".encode())
+    return digest.hexdigest()
+
+# Asset optimization
+#
+# optimize_dist runs after a build and before the dist is uploaded. It removes
+# files matching ASSET_EXCLUDE, minifies CSS and HTML conservatively (comments
+# and layout whitespace only; JS is left to esbuild when it is installed), writes
+# .gz/.br variants next to text assets so serve_file can send them as is, and
+# hardlinks files with identical content. Per-file work runs in a process pool
+# because minifying and brotli are CPU bound. Variants are not uploaded or
+# archived: storage and downloads only get the minified files.
+CSS_TOKENS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|(/\*.*?\*/)|\s+', re.S)
+HTML_RAW_BLOCKS = re.compile(r'(<(pre|textarea|script|style)\b[^>]*>)(.*?)(</\2\s*>)', re.S | re.I)
+HTML_COMMENTS = re.compile(r'<!--(?!\[if|<!|>).*?-->', re.S)
+asset_pool: Optional[ProcessPoolExecutor] = None
+asset_pool_lock = threading.Lock()
+
+def minify_css(text):
+    """Drop comments (except /*! notices) and whitespace that CSS does not need"""
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        if match.group(2):
+            return match.group(2) if match.group(2).startswith("/*!") else ""
+        before = text[match.start() - 1] if match.start() else "{"
+        after = text[match.end()] if match.end() < len(text) else "}"
+        return "" if before in "{};," or after in "{};," else " "
+    return CSS_TOKENS.sub(replace, text).strip()
+
+def minify_html(text):
+    """Drop comments and indentation from HTML, leaving pre, textarea and script contents alone"""
+    def compact(segment):
+        segment = HTML_COMMENTS.sub("", segment)
+        # A newline is still whitespace, so inline elements keep their spacing
+        return re.sub(r'\s*\n\s*', "\n", segment)
+    out = []
+    pos = 0
+    for match in HTML_RAW_BLOCKS.finditer(text):
+        out.append(compact(text[pos:match.start()]))
+        body = minify_css(match.group(3)) if match.group(2).lower() == "style" else match.group(3)
+        out.append(match.group(1) + body + match.group(4))
+        pos = match.end()
+    out.append(compact(text[pos:]))
+    return "".join(out).strip() + "\n"
+
+def minify_asset(data, rel_path, esbuild):
+    """Minified content of a dist file, or None if it is not minified"""
+    ext = os.path.splitext(rel_path)[1].lower()
+    if ext in (".js", ".mjs"):
+        if not esbuild or rel_path.endswith(".min.js"):
+            return None
+        completed = subprocess.run(
+            [esbuild, "--minify", "--loader=js", "--log-level=error"],
+            input=data, capture_output=True, timeout=ASSET_MINIFY_TIMEOUT, env=sandbox_env()
+        )
+        return completed.stdout if completed.returncode == 0 else None
+    if ext not in (".css", ".html", ".htm"):
+        return None
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    return (minify_css(text) if ext == ".css" else minify_html(text)).encode("utf-8")
+
+def compress_asset(data, encoding):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == "br" and brotli:
+        return brotli.compress(data, quality=11)
+    return None
+
+def optimize_asset(file_path, rel_path, minify, esbuild):
+    """Minify one dist file and write its compressed variants (runs in the asset pool)"""
+    result = {"path": rel_path, "before": 0, "after": 0, "minified": False, "gzip": None, "br": None, "sha256": None}
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        result["before"] = result["after"] = len(data)
+        minified = minify_asset(data, rel_path, esbuild) if minify else None
+        if minified is not None and len(minified) < len(data):
+            write_atomic(file_path, minified)
+            data = minified
+            result.update(after=len(data), minified=True)
+        result["sha256"] = hashlib.sha256(data).hexdigest()
+        
+        compressible = os.path.splitext(rel_path)[1].lower() not in PRECOMPRESSED_EXTENSIONS
+        for encoding, suffix in PRECOMPRESSED_VARIANTS:
+            compressed = None
+            if compressible and len(data) >= ASSET_COMPRESS_MIN_BYTES:
+                compressed = compress_asset(data, encoding)
+            # Only worth a second copy if it is clearly smaller
+            if compressed is not None and len(compressed) < len(data) * 0.9:
+                write_atomic(file_path + suffix, compressed)
+                result[encoding] = len(compressed)
+            elif os.path.exists(file_path + suffix):
+                os.remove(file_path + suffix)
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+def is_compressed_variant(file_path):
+    """Whether a file is a .gz/.br variant written next to the file it compresses"""
+    return any(
+        file_path.endswith(suffix) and os.path.isfile(file_path[:-len(suffix)])
+        for _, suffix in PRECOMPRESSED_VARIANTS
+    )
+
+def run_asset_jobs(jobs):
+    """Run optimize_asset over jobs, in the process pool unless there are only a few"""
+    global asset_pool
+    if len(jobs) < ASSET_POOL_MIN_FILES or ASSET_WORKERS <= 1:
+        return [optimize_asset(*job) for job in jobs]
+    with asset_pool_lock:
+        if asset_pool is None:
+            # Spawned rather than forked: the server process has running threads
+            asset_pool = ProcessPoolExecutor(ASSET_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        pool = asset_pool
+    try:
+        return list(pool.map(optimize_asset, *zip(*jobs), chunksize=max(1, len(jobs) // (ASSET_WORKERS * 4))))
+    except BrokenProcessPool as e:
+        print(f"Asset pool failed ({e}), optimizing in this process")
+        with asset_pool_lock:
+            if asset_pool is pool:
+                asset_pool = None
+        return [optimize_asset(*job) for job in jobs]
+
+def dedupe_assets(dist_dir, results):
+    """Hardlink dist files (and their variants) with identical content; returns (files, bytes) saved"""
+    first: Dict[str, str] = {}
+    files = saved = 0
+    for result in results:
+        if not result["sha256"] or not result["after"]:
+            continue
+        file_path = os.path.join(dist_dir, result["path"])
+        original = first.setdefault(result["sha256"], file_path)
+        if original == file_path:
+            continue
+        for _, suffix in [(None, "")] + PRECOMPRESSED_VARIANTS:
+            if not os.path.isfile(original + suffix) or os.path.samefile(original + suffix, file_path + suffix):
+                continue
+            tmp_path = f"{file_path}{suffix}.{uuid.uuid4().hex}.tmp"
             try:
-                # Upload to Supabase storage
-                signed_url = upload_and_sign(zip_file, zip_storage_path)
-                if signed_url:
-                    download_url = signed_url
-                    print(f"Uploaded to Supabase with signed URL: {download_url}")
-                else:
-                    print("Failed to upload to Supabase, using local file fallback")
-            except Exception as e:
-                print(f"Error uploading to Supabase: {e}")
-                # Continue with local file if Supabase upload fails
+                os.link(original + suffix, tmp_path)
+                os.replace(tmp_path, file_path + suffix)
+            except OSError as e:
+                print(f"Could not dedupe {result['path']}{suffix}: {e}")
+                continue
+            if not suffix:
+                files += 1
+                saved += result["after"]
+    return files, saved
+
+@stage("optimize_assets")
+def optimize_dist(dist_dir, source_dir=None):
+    """Filter, minify, precompress and dedupe a build's dist in place
+
+    With source_dir, dist_dir is first replaced by a copy of its distributable
+    files. Returns a summary of the savings.
+    """
+    started = time.monotonic()
+    summary = {
+        "files": 0, "excluded": 0, "excludedBytes": 0, "minified": 0, "bytesBefore": 0, "bytesAfter": 0,
+        "gzipBytes": 0, "brotliBytes": 0, "transferBytes": 0, "deduped": 0, "dedupedBytes": 0,
+        "savedBytes": 0, "errors": 0, "seconds": 0.0
+    }
+    if source_dir:
+        # Copies rather than hardlinks, so tools that rewrite sources in place do not change the dist
+        shutil.rmtree(dist_dir, ignore_errors=True)
+        for file_path, rel_path in walk_project(source_dir):
+            if is_ignored(rel_path) or matches_patterns(rel_path, ASSET_EXCLUDE):
+                summary["excluded"] += 1
+                summary["excludedBytes"] += os.path.getsize(file_path)
+                continue
+            dest_path = os.path.join(dist_dir, rel_path)
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            shutil.copy2(file_path, dest_path)
+            
+    jobs = []
+    for file_path, rel_path in list(walk_project(dist_dir)):
+        if is_compressed_variant(file_path):
+            continue
+        if matches_patterns(rel_path, ASSET_EXCLUDE):
+            summary["excluded"] += 1
+            summary["excludedBytes"] += os.path.getsize(file_path)
+            for _, suffix in [(None, "")] + PRECOMPRESSED_VARIANTS:
+                if os.path.exists(file_path + suffix):
+                    os.remove(file_path + suffix)
+            continue
+        jobs.append((file_path, rel_path.replace(os.sep, "/"), ASSET_MINIFY, shutil.which("esbuild")))
         
+    results = run_asset_jobs(jobs)
+    for result in results:
+        if result.get("error"):
+            summary["errors"] += 1
+            print(f"Could not optimize {result['path']}: {result['error']}")
+        summary["files"] += 1
+        summary["minified"] += result["minified"]
+        summary["bytesBefore"] += result["before"]
+        summary["bytesAfter"] += result["after"]
+        summary["gzipBytes"] += result["gzip"] or 0
+        summary["brotliBytes"] += result["br"] or 0
+        summary["transferBytes"] += min(size for size in (result["after"], result["gzip"], result["br"]) if size is not None)
+    summary["deduped"], summary["dedupedBytes"] = dedupe_assets(dist_dir, results)
+    
+    summary["savedBytes"] = summary["bytesBefore"] - summary["bytesAfter"] + summary["excludedBytes"]
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    inc_counter("asset_bytes_saved_total", summary["savedBytes"])
+    print(
+        f"Optimized {summary['files']} assets in {dist_dir}: {summary['bytesBefore']} -> {summary['bytesAfter']} bytes "
+        f"({summary['transferBytes']} compressed), {summary['excluded']} excluded, {summary['deduped']} deduplicated"
+    )
+    return summary
+
+def scan_dist(dist_dir, previous):
+    """Hash the files of a build's dist; returns the dist manifest and whether it changed"""
+    current = {
+        rel: entry for rel, entry in scan_project(dist_dir, previous).items()
+        if not is_compressed_variant(os.path.join(dist_dir, rel))
+    }
+    changed = {rel: entry["sha256"] for rel, entry in current.items()} != {
+        rel: entry.get("sha256") for rel, entry in previous.items()
+    }
+    return current, changed
+
+def build_project(job_id):
+    """Build the project for a job and upload the dist archive (runs in a worker thread)
+
+    Builds are skipped when the sources and pulled edits match the last successful
+    build, and the dist archive is only uploaded again when its contents changed.
+    """
+    proj = ensure_workspace(job_id)
+    
+    # Pull any edits from storage
+    edits = pull_edits(job_id, proj)
+    
+    manifest = load_manifest(proj)
+    previous_build = manifest.get("build") or {}
+    fingerprint = build_fingerprint(proj, manifest)
+    is_npm_project = os.path.exists(f"{proj}/package.json")
+    # Without package.json the project itself is served, through an optimized copy when enabled
+    output_dir = f"{ASSET_OUTPUT_ROOT}/{job_id}"
+    if is_npm_project:
+        dist_dir = f"{proj}/dist"
+        shutil.rmtree(output_dir, ignore_errors=True)
+    else:
+        dist_dir = output_dir if ASSET_OPTIMIZE else proj
+        if previous_build.get("assets") and not previous_build.get("outputDir"):
+            # Older builds put the optimized copy in the project's dist/
+            shutil.rmtree(f"{proj}/dist", ignore_errors=True)
+    preview_url = f"/preview/{job_id}"
+    dist_storage_path = f"{job_id}/dist.zip"
+    
+    if previous_build.get("fingerprint") == fingerprint and os.path.isdir(dist_dir):
+        print(f"Sources of job {job_id} unchanged since the last build, reusing it")
+        inc_counter("builds_total", result="skipped")
+        if storage:
+            signed_url = sign_storage_path(dist_storage_path)
+            if signed_url:
+                preview_url = signed_url.replace(".zip", "")
         return {
+            "status": "success",
             "jobId": job_id,
-            "download": download_url
+            "preview": preview_url,
+            "dependencies": None,
+            "edits": edits,
+            "assets": previous_build.get("assets"),
+            "build": {"fingerprint": fingerprint, "skipped": True, "distChanged": False}
         }
-    except Exception as e:
-        print(f"Error in /run: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(e))
+    
+    # Simple build process (for a real game this would do more)
+    inc_counter("builds_total", result="built")
+    dependencies = None
+    if is_npm_project:
+        # If there's a package.json, install dependencies (from the cache when possible) and build
+        dependencies = install_dependencies(proj)
+        with stage("npm_build"):
+            run(["npm", "run", "build"], cwd=proj)
+    # Otherwise just use the root as the "dist"
+    
+    assets = None
+    if ASSET_OPTIMIZE:
+        try:
+            assets = optimize_dist(dist_dir, None if is_npm_project else proj)
+        except Exception as e:
+            print(f"Error optimizing assets for job {job_id}: {e}")
+            traceback.print_exc()
+            if not is_npm_project:
+                shutil.rmtree(dist_dir, ignore_errors=True)
+                dist_dir = proj
+                
+    # Store in Supabase if available
+    dist_files, dist_changed = scan_dist(dist_dir, previous_build.get("dist", {}))
+    uploaded = True
+    if storage:
+        try:
+            # Only re-archive the dist when its contents changed
+            if dist_changed or not previous_build.get("fingerprint"):
+                signed_url = upload_archive_and_sign(
+                    dist_dir, dist_storage_path, lambda rel: is_compressed_variant(os.path.join(dist_dir, rel))
+                )
+            else:
+                signed_url = sign_storage_path(dist_storage_path)
+            if signed_url:
+                preview_url = signed_url.replace(".zip", "")  # Remove .zip extension for preview URL
+                print(f"Uploaded to Supabase with signed URL: {signed_url}")
+            else:
+                uploaded = False
+                print("Failed to upload dist to Supabase, using local file fallback")
+        except Exception as e:
+            uploaded = False
+            print(f"Error uploading to Supabase: {e}")
+            
+    # Remember the build so an unchanged project is not rebuilt; a failed upload
+    # leaves the old fingerprint so the next build retries it
+    if uploaded:
+        manifest = load_manifest(proj)
+        manifest["build"] = {"fingerprint": fingerprint, "dist": dist_files, "assets": assets, "outputDir": dist_dir}
+        save_manifest(proj, manifest)
+    
+    return {
+        "status": "success",
+        "jobId": job_id,
+        "preview": preview_url,
+        "dependencies": dependencies,
+        "edits": edits,
+        "assets": assets,
+        "build": {"fingerprint": fingerprint, "skipped": False, "distChanged": dist_changed}
+    }
 
 @app.post("/build")
 async def build_game(request: Request):
+    """Queue a build of the project and return the task ID right away"""
     try:
         data = await request.json()
         job_id = data.get("jobId")
@@ -278,115 +2738,176 @@ async def build_game(request: Request):
         if not job_id:
             raise HTTPException(status_code=400, detail="Job ID is required")
             
-        proj = f"/tmp/projects/{job_id}"
-        
-        # Check if project directory exists, if not create it
-        if not os.path.exists(proj):
-            os.makedirs(proj, exist_ok=True)
-            
-            # Download the original zip if it doesn't exist
-            if supabase:
-                try:
-                    # First, check if the zip file exists in storage
-                    try:
-                        response = supabase.storage.from_('game-builds').download(f"{job_id}.zip")
-                        
-                        # Save zip file
-                        zip_path = f"/tmp/{job_id}.zip"
-                        with open(zip_path, 'wb') as f:
-                            f.write(response)
-                            
-                        # Extract zip
-                        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                            zip_ref.extractall(proj)
-                            
-                        print(f"Downloaded and extracted from Supabase storage for job {job_id}")
-                    except Exception as zip_e:
-                        print(f"Could not download zip from Supabase: {zip_e}")
-                        
-                        # If zip doesn't exist, try to download individual files from projects folder
-                        try:
-                            project_files = supabase.storage.from_('game-builds').list(f"projects/{job_id}")
-                            
-                            for file_obj in project_files:
-                                file_path = file_obj['name']
-                                response = supabase.storage.from_('game-builds').download(f"projects/{job_id}/{file_path}")
-                                
-                                # Ensure the directory exists
-                                os.makedirs(os.path.dirname(os.path.join(proj, file_path)), exist_ok=True)
-                                
-                                # Write the file
-                                with open(os.path.join(proj, file_path), 'wb') as f:
-                                    f.write(response)
-                                    
-                            print(f"Downloaded individual project files from Supabase storage for job {job_id}")
-                        except Exception as proj_e:
-                            print(f"Could not download project files from Supabase: {proj_e}")
-                            
-                except Exception as e:
-                    print(f"Could not download from Supabase: {e}")
-        
-        # Pull any edits from storage
-        pull_edits(job_id, proj)
-        
-        # Simple build process (for a real game this would do more)
-        if os.path.exists(f"{proj}/package.json"):
-            # If there's a package.json, run npm install and build
-            run(["npm", "install"], cwd=proj)
-            run(["npm", "run", "build"], cwd=proj)
-            dist_dir = f"{proj}/dist"
-        else:
-            # Otherwise just use the root as the "dist"
-            dist_dir = proj
+        # Build where the workspace already is
+        proxied = await route_to_owner(request, job_id)
+        if proxied:
+            return proxied
             
-        # Create a zip file of the dist
-        dist_zip = shutil.make_archive(f"/tmp/{job_id}-dist", 'zip', dist_dir)
-        print(f"Created dist zip: {dist_zip}")
+        task = enqueue_task("build", job_id)
         
-        # Store in Supabase if available
-        preview_url = f"/preview/{job_id}"
-        dist_storage_path = f"{job_id}/dist.zip"
-        
-        if supabase:
-            try:
-                signed_url = upload_and_sign(dist_zip, dist_storage_path)
-                if signed_url:
-                    preview_url = signed_url.replace(".zip", "")  # Remove .zip extension for preview URL
-                    print(f"Uploaded to Supabase with signed URL: {signed_url}")
-                else:
-                    print("Failed to upload dist to Supabase, using local file fallback")
-            except Exception as e:
-                print(f"Error uploading to Supabase: {e}")
-        
-        return {
-            "status": "success",
-            "jobId": job_id,
-            "preview": preview_url
-        }
+        if data.get("wait"):
+            return await wait_for_task(task)
+        return JSONResponse(task_view(task), status_code=202)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in /build: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/logs/{job_id}")
-async def get_logs(job_id: str):
-    """Retrieve build logs for a specific job ID"""
-    log_file_path = f"/tmp/projects/{job_id}/build.log"
+async def get_logs(
+    job_id: str, request: Request, offset: Optional[int] = None, limit: Optional[int] = None, tail: Optional[int] = None
+):
+    """Retrieve build logs for a specific job ID
+
+    Without an offset the last `tail` (LOG_TAIL_LINES) lines are returned. Pass
+    `offset` (a byte offset, 0 to start) and optionally `limit` to page through
+    the log; the response's `nextOffset` is where the next poll should continue.
+    """
+    proxied = await route_to_owner(request, job_id)
+    if proxied:
+        return proxied
+    log_file_path = job_log_path(job_id)
+    touch_workspace(job_id)
     
-    if os.path.exists(log_file_path):
+    if log_exists(log_file_path):
         try:
-            with open(log_file_path, "r") as log_file:
-                logs = log_file.readlines()
-            return {"jobId": job_id, "logs": logs}
+            if tail is not None or (offset is None and limit is None):
+                lines = await asyncio.to_thread(
+                    tail_log_lines, log_file_path, max(1, min(tail or LOG_TAIL_LINES, LOG_PAGE_LINES))
+                )
+                size = lines[-1][1] if lines else await asyncio.to_thread(log_size, log_file_path)
+                return {
+                    "jobId": job_id,
+                    "logs": [line for _, _, line in lines],
+                    "offset": lines[0][0] if lines else size,
+                    "nextOffset": size,
+                }
+                
+            offset = max(0, offset or 0)
+            lines = await asyncio.to_thread(
+                read_log_lines, log_file_path, offset, max(1, min(limit or LOG_PAGE_LINES, LOG_PAGE_LINES))
+            )
+            return {
+                "jobId": job_id,
+                "logs": [line for _, _, line in lines],
+                "offset": offset,
+                "nextOffset": lines[-1][1] if lines else offset,
+            }
         except Exception as e:
             print(f"Error reading log file: {e}")
             raise HTTPException(status_code=500, detail=str(e))
     else:
-        return {"jobId": job_id, "logs": ["No logs found for this job."]}
+        return {"jobId": job_id, "logs": ["No logs found for this job."], "offset": 0, "nextOffset": 0}
+
+@app.get("/logs/{job_id}/stream")
+async def stream_logs(job_id: str, request: Request, offset: Optional[int] = None, follow: bool = True):
+    """Stream build logs as Server-Sent Events, resuming from `offset` or Last-Event-ID"""
+    proxied = await route_to_owner(request, job_id)
+    if proxied:
+        return proxied
+    if not os.path.isdir(f"/tmp/projects/{job_id}"):
+        raise HTTPException(status_code=404, detail="Project directory not found")
+        
+    touch_workspace(job_id)
+    last_event_id = request.headers.get("last-event-id")
+    if offset is None and last_event_id and last_event_id.isdigit():
+        offset = int(last_event_id)
+        
+    return StreamingResponse(
+        stream_job_log(job_id, max(0, offset or 0), follow),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def improve_project(job_id, prompt):
+    """Run GPT-Engineer on the project and upload the changes (runs in a worker thread)"""
+    proj_dir = ensure_workspace(job_id)
+    
+    # Pull any edits from storage
+    edits = pull_edits(job_id, proj_dir)
+    
+    # Reuse the result of the same prompt on the same project snapshot
+    before = scan_project(proj_dir, load_manifest(proj_dir)["files"])
+    cache_key = prompt_cache_key("improve", prompt, snapshot_hash(before))
+    cached = prompt_cache_get(cache_key)
+    if cached and apply_improve_result(cached, proj_dir):
+        PROMPT_CACHE_STATS["hits"] += 1
+        inc_counter("prompt_cache_requests_total", kind="improve", result="hit")
+        print(f"Prompt cache hit for job {job_id}, skipping GPT-Engineer")
+        with get_job_log(job_id) as log_file:
+            log_file.write("Reusing the result of an identical earlier request\n")
+        if storage:
+            sync_project(job_id, proj_dir, f"Upload improved project {job_id}")
+        return {"status": "success", "jobId": job_id, "cache": "hit", "edits": edits}
+    PROMPT_CACHE_STATS["misses"] += 1
+    inc_counter("prompt_cache_requests_total", kind="improve", result="miss")
+    
+    # GPT-Engineer is about to change files that are not in storage yet
+    mark_workspace_synced(job_id, False)
+    
+    # Construct the GPT-Engineer prompt
+    full_prompt = f"{prompt}\n\nHere is the existing code (read-only): {proj_dir}"
+    
+    # Define environment variables for the subprocess
+    env = {"GPTE_AUTO_EXECUTE": "true"}  # Ensure GPT-Engineer runs non-interactively
+    
+    # Run GPT-Engineer with the prompt and project directory
+    command = ["gpte", "--llm=gpt-4", "--model=gpt-4", "--temperature=0.8", proj_dir]
+    
+    # Log the command and prompt
+    print(f"Running GPT-Engineer with command: {' '.join(command)}")
+    print(f"GPT-Engineer prompt: {full_prompt}")
+    
+    # Open the log file for appending (and for live subscribers)
+    with stage("gpte"), get_job_log(job_id) as log_file:
+        echoed = 0
+        
+        def on_line(line):
+            nonlocal echoed
+            # Print to server console, up to LOG_ECHO_LINES lines per run
+            if LOG_ECHO_LINES < 0 or echoed < LOG_ECHO_LINES:
+                print(line.strip()[:LOG_ECHO_LINE_CHARS])
+            elif echoed == LOG_ECHO_LINES:
+                print(f"[{job_id}] Further GPT-Engineer output is only written to build.log")
+            echoed += 1
+            log_file.write(line)  # Write to log file and notify subscribers
+            
+        # Run the GPT-Engineer command in a build slot, streaming its output to the log
+        result = run_sandboxed(command, cwd=proj_dir, env=env, timeout=GPTE_TIMEOUT, on_line=on_line)
+        
+        # Check the return code
+        if result["timedOut"]:
+            error_message = f"GPT-Engineer timed out after {GPTE_TIMEOUT:.0f}s"
+        elif result["exitCode"] != 0:
+            error_message = f"GPT-Engineer failed with return code: {result['exitCode']}"
+        else:
+            error_message = None
+        if error_message:
+            print(error_message)
+            log_file.write(error_message + "\n")
+            raise RuntimeError(error_message)
+    
+    # Remember what this prompt changed so an identical request can reuse it
+    try:
+        store_improve_result(cache_key, proj_dir, before, scan_project(proj_dir, before))
+    except Exception as e:
+        print(f"Could not cache improve result for job {job_id}: {e}")
+        
+    # After GPT-Engineer has run, upload the changes to Supabase storage
+    proj_storage_path = f"projects/{job_id}"
+    print(f"Saving improved project files to Supabase storage: {proj_storage_path}")
+    
+    # Upload only the files that changed and remove deleted ones
+    if storage:
+        sync_project(job_id, proj_dir, f"Upload improved project {job_id}")
+    
+    return {"status": "success", "jobId": job_id, "cache": "miss", "edits": edits}
 
 @app.post("/improve")
 async def improve_game(request: Request):
-    """Endpoint to improve the game using GPT-Engineer"""
+    """Queue a GPT-Engineer improvement of the game and return the task ID right away"""
     try:
         data = await request.json()
         job_id = data.get("jobId")
@@ -397,132 +2918,1078 @@ async def improve_game(request: Request):
         if not prompt:
             raise HTTPException(status_code=400, detail="Prompt is required")
             
-        proj_dir = f"/tmp/projects/{job_id}"
-        log_file_path = os.path.join(proj_dir, "build.log")
-        
-        # Make sure the project directory exists
-        if not os.path.exists(proj_dir):
+        # Improve where the workspace already is
+        proxied = await route_to_owner(request, job_id)
+        if proxied:
+            return proxied
+            
+        # Make sure the project directory exists (or can be restored from storage)
+        if not os.path.exists(f"/tmp/projects/{job_id}") and not storage:
             raise HTTPException(status_code=404, detail="Project directory not found")
             
-        # Pull any edits from storage
-        pull_edits(job_id, proj_dir)
-        
-        # Construct the GPT-Engineer prompt
-        full_prompt = f"{prompt}\n\nHere is the existing code (read-only): {proj_dir}"
-        
-        # Define environment variables for the subprocess
-        env = os.environ.copy()
-        env["GPTE_AUTO_EXECUTE"] = "true"  # Ensure GPT-Engineer runs non-interactively
-        
-        # Run GPT-Engineer with the prompt and project directory
-        command = ["gpte", "--llm=gpt-4", "--model=gpt-4", "--temperature=0.8", proj_dir]
-        
-        # Log the command and prompt
-        print(f"Running GPT-Engineer with command: {' '.join(command)}")
-        print(f"GPT-Engineer prompt: {full_prompt}")
+        # Coalesce onto an identical improve of this project that is still queued or running
+        task = find_active_task("improve", job_id, normalize_prompt(prompt))
+        coalesced = task is not None
+        if coalesced:
+            PROMPT_CACHE_STATS["coalesced"] += 1
+            inc_counter("prompt_cache_requests_total", kind="improve", result="coalesced")
+            print(f"Coalescing duplicate improve for job {job_id} onto task {task['taskId']}")
+        else:
+            task = enqueue_task("improve", job_id, {"prompt": prompt, "dedupeKey": normalize_prompt(prompt)})
         
-        # Open the log file for appending
-        with open(log_file_path, "a") as log_file:
-            # Run the GPT-Engineer command and capture its output
-            process = subprocess.Popen(
-                command,
-                cwd=proj_dir,
-                env=env,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True
-            )
-            
-            # Read the output line by line and write it to the log file
-            while True:
-                line = process.stdout.readline()
-                if not line:
-                    break
-                print(line.strip())  # Print to server console
-                log_file.write(line)  # Write to log file
-                log_file.flush()  # Ensure immediate write to disk
-            
-            # Wait for the process to complete and check the return code
-            process.wait()
-            if process.returncode != 0:
-                error_message = f"GPT-Engineer failed with return code: {process.returncode}"
-                print(error_message)
-                log_file.write(error_message + "\n")
-                raise HTTPException(status_code=500, detail=error_message)
-        
-        # After GPT-Engineer has run, upload the changes to Supabase storage
-        proj_storage_path = f"projects/{job_id}"
-        print(f"Saving improved project files to Supabase storage: {proj_storage_path}")
-        
-        # Walk through the project directory and upload each file
-        for root, _, files in os.walk(proj_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                rel_path = os.path.relpath(file_path, proj_dir)
-                storage_path = f"{proj_storage_path}/{rel_path}"
-                
-                # Determine content type based on file extension
-                content_type = "text/plain"
-                if file.endswith(".html"):
-                    content_type = "text/html"
-                elif file.endswith(".js"):
-                    content_type = "application/javascript"
-                elif file.endswith(".css"):
-                    content_type = "text/css"
-                elif file.endswith(".json"):
-                    content_type = "application/json"
-                    
-                try:
-                    with open(file_path, 'rb') as f:
-                        file_data = f.read()
-                        if supabase:
-                            result = supabase.storage.from_('game-builds').upload(
-                                path=storage_path,
-                                file=file_data,
-                                file_options={"content-type": content_type, "upsert": "true"}
-                            )
-                            print(f"Uploaded {storage_path} to storage: {result}")
-                except Exception as e:
-                    print(f"Error uploading {storage_path}: {e}")
-        
-        return {"status": "success", "jobId": job_id}
+        if data.get("wait"):
+            result = await wait_for_task(task)
+            return {**result, "cache": "coalesced"} if coalesced else result
+        return JSONResponse({**task_view(task), "coalesced": coalesced}, status_code=202)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in /improve: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/download/{job_id}")
-async def download_game(job_id: str):
+async def download_game(job_id: str, request: Request):
     """Serve the zip file for a specific job ID"""
+    proxied = await route_to_owner(request, job_id)
+    if proxied:
+        return proxied
+    touch_workspace(job_id)
+    proj = f"/tmp/projects/{job_id}"
     file_path = f"/tmp/{job_id}.zip"
+    headers = {"Content-Disposition": f'attachment; filename="{job_id}.zip"'}
     
-    if os.path.exists(file_path):
+    # A project that only exists in memory so far is served from its zip
+    with pending_scaffolds_lock:
+        scaffold = PENDING_SCAFFOLDS.get(job_id)
+    if scaffold:
+        return Response(scaffold["zip"], media_type="application/zip", headers=headers)
+        
+    # An evicted project is restored from storage first
+    if not os.path.isdir(proj) and not os.path.exists(file_path) and storage:
+        try:
+            await asyncio.to_thread(ensure_workspace, job_id)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="File not found")
+        
+    # Stream a zip of the current project without writing it to disk
+    if os.path.isdir(proj):
+        return StreamingResponse(
+            iter_zip(proj, exclude=is_ignored),
+            media_type="application/zip",
+            headers=headers
+        )
+    elif os.path.exists(file_path):
         return FileResponse(file_path, media_type="application/zip", filename=f"{job_id}.zip")
     else:
         raise HTTPException(status_code=404, detail="File not found")
 
+# Static file serving
+#
+# serve_file answers GET requests for files in a workspace with the right MIME
+# type, ETag/Last-Modified validators, conditional GETs, single byte-range
+# requests and precompressed .br/.gz variants when the client accepts them.
+# Small files are served from an LRU cache keyed on path, size and mtime, so a
+# popular preview is read from disk once rather than once per player.
+HOT_FILES: "OrderedDict[tuple, bytes]" = OrderedDict()
+hot_files_lock = threading.Lock()
+HOT_FILE_STATS = {"hits": 0, "misses": 0, "bytes": 0}
+PRECOMPRESSED_VARIANTS = [("br", ".br"), ("gzip", ".gz")]
+
+def safe_join(root, rel_path):
+    """Join a request path onto a directory, refusing anything that escapes it"""
+    root = os.path.realpath(root)
+    full_path = os.path.realpath(os.path.join(root, rel_path))
+    if full_path != root and not full_path.startswith(root + os.sep):
+        return None
+    return full_path
+
+def read_hot_file(file_path, stat):
+    """Read a small file through the hot-file cache"""
+    key = (file_path, stat.st_size, stat.st_mtime_ns)
+    with hot_files_lock:
+        data = HOT_FILES.get(key)
+        if data is not None:
+            HOT_FILES.move_to_end(key)
+            HOT_FILE_STATS["hits"] += 1
+            return data
+            
+    with open(file_path, "rb") as f:
+        data = f.read()
+        
+    with hot_files_lock:
+        HOT_FILE_STATS["misses"] += 1
+        if key not in HOT_FILES:
+            HOT_FILES[key] = data
+            HOT_FILE_STATS["bytes"] += len(data)
+        while HOT_FILE_STATS["bytes"] > PREVIEW_CACHE_MAX_BYTES and HOT_FILES:
+            _, evicted = HOT_FILES.popitem(last=False)
+            HOT_FILE_STATS["bytes"] -= len(evicted)
+    return data
+
+def iter_file_range(file_path, start, length):
+    """Yield `length` bytes of a file starting at `start`, in chunks"""
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(ZIP_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def parse_range(range_header, size):
+    """Parse a single 'bytes=' range; None to ignore the header, False if unsatisfiable"""
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start, _, end = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start == "":
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+def etag_matches(header, etag):
+    """Check an If-None-Match/If-Range header value against an ETag"""
+    if header.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in header.split(","))
+
+async def serve_file(request: Request, file_path, media_type=None, precompressed=True, etag=None):
+    """Serve a file with validators, conditional GETs, ranges and precompressed variants
+
+    `etag` replaces the default mtime/size validator (e.g. with a content hash).
+    """
+    media_type = media_type or mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+    range_header = request.headers.get("range")
+    
+    # Pick a precompressed variant, unless the client asked for a byte range
+    encoding = None
+    serve_path = file_path
+    if precompressed and not range_header:
+        accepted = request.headers.get("accept-encoding", "")
+        for name, suffix in PRECOMPRESSED_VARIANTS:
+            if name in accepted and os.path.isfile(file_path + suffix):
+                encoding, serve_path = name, file_path + suffix
+                break
+                
+    stat = os.stat(serve_path)
+    etag = etag or f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{"-" + encoding if encoding else ""}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": email.utils.formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": PREVIEW_CACHE_CONTROL,
+    }
+    if precompressed:
+        headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        
+    # Conditional GET
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif if_modified_since:
+        try:
+            if int(stat.st_mtime) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+            
+    # Byte ranges (ignored if If-Range names another version)
+    byte_range = None
+    if range_header and etag_matches(request.headers.get("if-range", etag), etag):
+        byte_range = parse_range(range_header, stat.st_size)
+        if byte_range is False:
+            headers["Content-Range"] = f"bytes */{stat.st_size}"
+            return Response(status_code=416, headers=headers)
+    start, end = byte_range or (0, stat.st_size - 1)
+    length = max(0, end - start + 1)
+    status_code = 206 if byte_range else 200
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+        
+    if stat.st_size <= PREVIEW_CACHE_MAX_FILE_BYTES:
+        data = await asyncio.to_thread(read_hot_file, serve_path, stat)
+        return Response(data[start:start + length], status_code=status_code, media_type=media_type, headers=headers)
+        
+    headers["Content-Length"] = str(length)
+    return StreamingResponse(iter_file_range(serve_path, start, length), status_code=status_code, media_type=media_type, headers=headers)
+
+def preview_root(job_id):
+    """Directory a job's preview is served from: the optimized copy, dist/ after an npm build, else the project"""
+    proj = f"/tmp/projects/{job_id}"
+    for dist_dir in (f"{ASSET_OUTPUT_ROOT}/{job_id}", os.path.join(proj, "dist")):
+        if os.path.isdir(dist_dir):
+            return dist_dir
+    return proj
+
 @app.get("/preview/{job_id}")
-async def preview_game(job_id: str):
+async def preview_game(job_id: str, request: Request):
     """Serve the index.html file for preview"""
-    file_path = f"/tmp/projects/{job_id}/dist/index.html"
-    
-    if os.path.exists(file_path):
-        return FileResponse(file_path, media_type="text/html")
-    else:
+    return await preview_asset(job_id, "index.html", request)
+
+@app.get("/preview/{job_id}/{asset_path:path}")
+async def preview_asset(job_id: str, asset_path: str, request: Request):
+    """Serve any file from the built preview"""
+    proxied = await route_to_owner(request, job_id)
+    if proxied:
+        return proxied
+    touch_workspace(job_id)
+    await restore_if_missing(job_id)
+    root = preview_root(job_id)
+    file_path = safe_join(root, asset_path or "index.html")
+    if file_path and os.path.isdir(file_path):
+        file_path = os.path.join(file_path, "index.html")
+        
+    # Only serve build output, never logs, manifests or dependencies
+    if not file_path or not os.path.isfile(file_path) or is_ignored(os.path.relpath(file_path, os.path.realpath(root))):
         raise HTTPException(status_code=404, detail="File not found")
+        
+    return await serve_file(request, file_path)
+
+# File patches
+#
+# Editors change files with PATCH /file/{job_id}/{path}, sending either a unified
+# diff or a list of {start, end, text} character ranges against the sha256 of the
+# version they started from (baseHash). A stale baseHash is a 409 conflict.
+# Patches are applied atomically (temp file + os.replace) and appended to a log
+# in storage under patches/{job_id}/{path}/. Every PATCH_COMPACT_EVERY patches
+# the file is written as a snapshot to edits/{job_id}/{path}, where pull_edits
+# already looks, and the log up to it is deleted. pull_edits replays any logged
+# patches a workspace has not seen yet. GET /file/...?base=<hash> answers with a
+# unified diff from that version when it is still in the version cache.
+FILE_VERSIONS: "OrderedDict[str, bytes]" = OrderedDict()
+FILE_HASHES: "OrderedDict[tuple, str]" = OrderedDict()
+file_versions_lock = threading.Lock()
+file_versions_bytes = 0
+
+class PatchConflict(Exception):
+    """A patch does not apply to the current version of a file"""
+    def __init__(self, message, current_hash=None):
+        super().__init__(message)
+        self.current_hash = current_hash
+
+def remember_version(data):
+    """Keep a file version for later ?base= diffs, returning its hash"""
+    global file_versions_bytes
+    digest = hashlib.sha256(data).hexdigest()
+    if len(data) > FILE_VERSION_CACHE_BYTES // 4:
+        return digest
+    with file_versions_lock:
+        if digest not in FILE_VERSIONS:
+            FILE_VERSIONS[digest] = data
+            file_versions_bytes += len(data)
+        FILE_VERSIONS.move_to_end(digest)
+        while file_versions_bytes > FILE_VERSION_CACHE_BYTES:
+            _, evicted = FILE_VERSIONS.popitem(last=False)
+            file_versions_bytes -= len(evicted)
+    return digest
+
+def content_hash(file_path):
+    """sha256 of a file, cached by path, size and mtime"""
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_size, stat.st_mtime_ns)
+    with file_versions_lock:
+        digest = FILE_HASHES.get(key)
+    if digest:
+        return digest
+    with open(file_path, 'rb') as f:
+        digest = remember_version(f.read())
+    with file_versions_lock:
+        FILE_HASHES[key] = digest
+        while len(FILE_HASHES) > 4096:
+            FILE_HASHES.popitem(last=False)
+    return digest
+
+def normalize_hash(value):
+    """Accept a hash as sent in baseHash, ?base= or an ETag"""
+    if value is None:
+        return None
+    return value.strip().removeprefix("W/").strip('"') or None
+
+def apply_unified_diff(text, patch):
+    """Apply a unified diff to text, raising PatchConflict if its context does not match"""
+    lines = text.splitlines(keepends=True)
+    out = []
+    pos = 0
+    previous = None
+    in_hunk = False
+    for line in patch.splitlines(keepends=True):
+        if line.startswith("@@"):
+            try:
+                old_range = line.split()[1]
+                start = int(old_range[1:].split(",")[0])
+                count = int(old_range.split(",")[1]) if "," in old_range else 1
+            except (IndexError, ValueError):
+                raise ValueError(f"Malformed hunk header: {line.strip()}")
+            # A hunk that only adds lines names the line before the insertion
+            start = start if count == 0 else start - 1
+            if start < pos or start > len(lines):
+                raise PatchConflict(f"Hunk at line {start + 1} is out of order or past the end of the file")
+            out.extend(lines[pos:start])
+            pos = start
+            in_hunk = True
+        elif not in_hunk:
+            continue  # file headers (diff, index, ---, +++)
+        elif line.startswith("\\"):
+            # "\ No newline at end of file" applies to the line before it
+            if previous == "+" and out:
+                out[-1] = out[-1].rstrip("\r\n")
+        elif line[:1] in (" ", "-"):
+            if pos >= len(lines) or lines[pos].rstrip("\r\n") != line[1:].rstrip("\r\n"):
+                raise PatchConflict(f"Patch does not match line {pos + 1}")
+            if line[0] == " ":
+                out.append(lines[pos])
+            pos += 1
+        elif line.startswith("+"):
+            added = line[1:]
+            out.append(added if added.endswith("\n") else added + "\n")
+        elif line.strip():
+            raise ValueError(f"Unexpected line in patch: {line.strip()}")
+        previous = line[:1]
+    out.extend(lines[pos:])
+    return "".join(out)
+
+def apply_range_edits(text, edits):
+    """Apply [{start, end, text}] character range replacements to text"""
+    spans = sorted(((int(edit["start"]), int(edit["end"]), str(edit.get("text", ""))) for edit in edits), reverse=True)
+    limit = len(text)
+    for start, end, replacement in spans:
+        if not 0 <= start <= end <= limit:
+            raise ValueError(f"Edit range {start}-{end} is outside the file or overlaps another edit")
+        text = text[:start] + replacement + text[end:]
+        limit = start
+    return text
+
+def apply_patch_body(text, body):
+    """Apply the 'patch' or 'edits' of a PATCH body (or logged patch) to text"""
+    if body.get("patch") is not None:
+        return apply_unified_diff(text, body["patch"])
+    if body.get("edits") is not None:
+        return apply_range_edits(text, body["edits"])
+    raise ValueError("Either 'patch' or 'edits' is required")
+
+def write_atomic(file_path, data):
+    """Replace a file's contents in one step so readers never see a partial write"""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(file_path), f".{os.path.basename(file_path)}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    if os.path.exists(file_path):
+        shutil.copymode(file_path, tmp_path)
+    os.replace(tmp_path, file_path)
+
+def patch_object_name(seq, digest):
+    return f"{seq:020d}-{digest[:12]}.json"
+
+async def download_patches(storage_paths):
+    """Download logged patches concurrently, in the order given"""
+    async def download(storage_path):
+        data = await storage_request("download", f"Download of {storage_path}", storage.download, storage_path)
+        inc_counter("storage_bytes_total", len(data), direction="download")
+        return json.loads(data)
+    return await asyncio.gather(*(download(storage_path) for storage_path in storage_paths))
+
+def compact_patches(job_id, rel_path, data, seq):
+    """Store a file as an edit snapshot and drop the logged patches it includes"""
+    snapshot_path = f"edits/{job_id}/{rel_path}"
+    run_storage(upload_data(data, snapshot_path, guess_content_type(rel_path)))
+    logged = list_tree(f"patches/{job_id}/{rel_path}", f"List patches of {rel_path}")
+    remove_objects(
+        [f"patches/{job_id}/{rel_path}/{entry['name']}" for entry in logged if int(entry["name"].split("-")[0]) <= seq],
+        f"Compact patches of {rel_path}"
+    )
+    print(f"Compacted {len(logged)} patches of {rel_path} for job {job_id} into a snapshot")
+    # Storage eTags of simple uploads are the content md5, so pull_edits can skip our own snapshot
+    return {"etag": f'"{hashlib.md5(data).hexdigest()}"', "updatedAt": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())}
+
+def apply_file_patch(job_id, rel_path, body):
+    """Apply a PATCH request to a workspace file, log it and compact the log when due"""
+    proj = ensure_workspace(job_id)
+    file_path = safe_join(proj, rel_path)
+    if not file_path or is_ignored(rel_path) or os.path.isdir(file_path):
+        raise FileNotFoundError(rel_path)
+        
+    exists = os.path.isfile(file_path)
+    current_hash = content_hash(file_path) if exists else None
+    if normalize_hash(body.get("baseHash")) != current_hash:
+        raise PatchConflict("baseHash does not match the current version", current_hash)
+        
+    old_data = b""
+    if exists:
+        with open(file_path, 'rb') as f:
+            old_data = f.read()
+    try:
+        old_text = old_data.decode("utf-8")
+    except UnicodeDecodeError:
+        raise UnicodeError("Only UTF-8 text files can be patched")
+    try:
+        new_data = apply_patch_body(old_text, body).encode("utf-8")
+    except PatchConflict as e:
+        e.current_hash = current_hash
+        raise
+    new_hash = remember_version(new_data)
+    seq = time.time_ns()
+    
+    # Log the patch so other nodes and later restores can replay it. The log entry
+    # is uploaded before the file is replaced, so a failed upload leaves the
+    # workspace at the base version and the client can retry with the same baseHash
+    entry = {"seq": seq, "path": rel_path, "baseHash": current_hash, "hash": new_hash}
+    entry.update({key: body[key] for key in ("patch", "edits") if body.get(key) is not None})
+    log_path = f"patches/{job_id}/{rel_path}/{patch_object_name(seq, new_hash)}"
+    if storage:
+        run_storage(upload_data(json.dumps(entry).encode(), log_path, "application/json"))
+    try:
+        write_atomic(file_path, new_data)
+    except OSError:
+        # Do not leave a logged patch that this workspace never applied
+        if storage:
+            remove_objects([log_path], f"Remove unapplied patch of {rel_path}")
+        raise
+    mark_workspace_synced(job_id, False)
+    
+    manifest = load_manifest(proj)
+    state = manifest.setdefault("patches", {}).get(rel_path, {"count": 0})
+    if storage:
+        state["count"] += 1
+        if state["count"] >= PATCH_COMPACT_EVERY:
+            try:
+                manifest["edits"][rel_path] = compact_patches(job_id, rel_path, new_data, seq)
+                state["count"] = 0
+            except Exception as e:
+                print(f"Error compacting patches of {rel_path} for job {job_id}: {e}")
+    state.update(seq=seq, hash=new_hash)
+    manifest["patches"][rel_path] = state
+    save_manifest(proj, manifest)
+    
+    print(f"Patched {rel_path} for job {job_id}: {len(old_data)} -> {len(new_data)} bytes")
+    return {"path": rel_path, "baseHash": current_hash, "hash": new_hash, "size": len(new_data), "seq": seq}
+
+def replay_patches(job_id, project_dir, manifest, reset_paths=()):
+    """Apply logged patches a workspace has not seen yet, in order
+
+    Files in reset_paths were just replaced by a snapshot, so every patch still
+    in their log is replayed on top of it. Returns how many patches were applied.
+    """
+    logged = list_tree(f"patches/{job_id}", f"List patches for {job_id}")
+    by_file: Dict[str, list] = {}
+    for entry in logged:
+        rel_path, _, name = entry["name"].rpartition("/")
+        if rel_path and name.endswith(".json"):
+            by_file.setdefault(rel_path, []).append((int(name.split("-")[0]), name))
+            
+    applied = 0
+    patches = manifest.setdefault("patches", {})
+    for rel_path, entries in by_file.items():
+        seen = 0 if rel_path in reset_paths else patches.get(rel_path, {}).get("seq", 0)
+        pending = sorted(entry for entry in entries if entry[0] > seen)
+        file_path = safe_join(project_dir, rel_path)
+        if not pending or not file_path:
+            continue
+            
+        logged_patches = run_storage(download_patches([f"patches/{job_id}/{rel_path}/{name}" for _, name in pending]))
+        current_hash = None
+        text = ""
+        if os.path.isfile(file_path):
+            current_hash = content_hash(file_path)
+            with open(file_path, 'rb') as f:
+                try:
+                    text = f.read().decode("utf-8")
+                except UnicodeDecodeError:
+                    print(f"Not replaying patches of {rel_path}: not a UTF-8 file")
+                    continue
+        state = patches.setdefault(rel_path, {"count": 0})
+        replayed = 0
+        for patch in logged_patches:
+            if patch["baseHash"] != current_hash:
+                # Already included in the file (or from a different history)
+                continue
+            try:
+                text = apply_patch_body(text, patch)
+            except (PatchConflict, ValueError) as e:
+                print(f"Could not replay patch {patch['seq']} of {rel_path}: {e}")
+                break
+            current_hash = patch["hash"]
+            state.update(seq=patch["seq"], hash=current_hash, count=state.get("count", 0) + 1)
+            replayed += 1
+        if replayed:
+            write_atomic(file_path, text.encode("utf-8"))
+            applied += replayed
+    if applied:
+        print(f"Replayed {applied} logged patches for job {job_id}")
+    return applied
 
 @app.get("/file/{job_id}/{file_path:path}")
-async def get_file(job_id: str, file_path: str):
-    """Retrieve a specific file from the project directory"""
-    full_path = os.path.join("/tmp/projects", job_id, file_path)
+async def get_file(job_id: str, file_path: str, request: Request, base: Optional[str] = None):
+    """Retrieve a specific file from the project directory
+
+    The ETag is the sha256 of the content. With `base` (an earlier ETag) the
+    response is a unified diff from that version (text/x-diff) when it is known.
+    """
+    proxied = await route_to_owner(request, job_id)
+    if proxied:
+        return proxied
+    touch_workspace(job_id)
+    await restore_if_missing(job_id)
+    full_path = safe_join(os.path.join("/tmp/projects", job_id), file_path)
     
-    if os.path.exists(full_path):
+    if full_path and os.path.isfile(full_path):
         try:
-            with open(full_path, "r") as f:
-                content = f.read()
-            return Response(content, media_type="text/plain")
+            current_hash = await asyncio.to_thread(content_hash, full_path)
+            base = normalize_hash(base)
+            if base:
+                headers = {"ETag": f'"{current_hash}"', "X-Base-Hash": base}
+                if base == current_hash:
+                    return Response(b"", media_type="text/x-diff", headers=headers)
+                with file_versions_lock:
+                    old_data = FILE_VERSIONS.get(base)
+                if old_data is not None:
+                    def make_diff():
+                        with open(full_path, 'rb') as f:
+                            new_text = f.read().decode("utf-8")
+                        return "".join(difflib.unified_diff(
+                            old_data.decode("utf-8").splitlines(keepends=True),
+                            new_text.splitlines(keepends=True),
+                            f"a/{file_path}",
+                            f"b/{file_path}"
+                        ))
+                    try:
+                        diff = await asyncio.to_thread(make_diff)
+                        return Response(diff, media_type="text/x-diff", headers=headers)
+                    except UnicodeDecodeError:
+                        pass  # binary files are sent whole
+            return await serve_file(
+                request, full_path, media_type="text/plain; charset=utf-8", precompressed=False, etag=f'"{current_hash}"'
+            )
         except Exception as e:
             print(f"Error reading file: {e}")
             raise HTTPException(status_code=500, detail=str(e))
     else:
         raise HTTPException(status_code=404, detail="File not found")
+
+@app.patch("/file/{job_id}/{file_path:path}")
+async def patch_file(job_id: str, file_path: str, request: Request):
+    """Apply a unified diff or range edits to a file, checked against its baseHash"""
+    proxied = await route_to_owner(request, job_id)
+    if proxied:
+        return proxied
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+        
+    # Wait briefly for a running build or improve of the project to finish
+    try:
+        async with workspace_lock(job_id, PATCH_LOCK_TIMEOUT):
+            result = await asyncio.to_thread(apply_file_patch, job_id, file_path, body)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=423, detail="Project is busy, try again later", headers={"Retry-After": "5"})
+    except PatchConflict as e:
+        return JSONResponse({"error": "conflict", "message": str(e), "currentHash": e.current_hash}, status_code=409)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    except UnicodeError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Error patching file: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+        
+    touch_workspace(job_id)
+    return JSONResponse(result, headers={"ETag": f'"{result["hash"]}"'})
+
+# Shared job state and node routing
+#
+# Server processes on one host share WORKSPACE_ROOT, so they see each other's
+# workspaces as local and coordinate through workspace_lock instead of routing.
+# Across hosts, each workspace lives on one node. The job state backend
+# records which node owns a workspace and the status of every task, so any node
+# can answer /tasks and knows where a job's files are. Requests for a job whose
+# workspace is on another node are proxied there (marked with NODE_HEADER so
+# they are never forwarded twice); if that node has no URL or cannot be reached
+# the workspace is restored from storage here and this node takes it over.
+# The backends here (memory, SQLite) are only shared within one host; routing
+# between hosts needs a job state backend they can all reach.
+NODE_HEADER = "x-game-node"
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te",
+    "trailers", "transfer-encoding", "upgrade", "host", "content-length",
+}
+
+class MemoryJobState:
+    """Job state kept in this process (a single node)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owners: Dict[str, dict] = {}
+        self.tasks: Dict[str, dict] = {}
+        
+    def set_owner(self, job_id, node_id, node_url):
+        with self.lock:
+            self.owners[job_id] = {"nodeId": node_id, "nodeUrl": node_url, "updatedAt": time.time()}
+            
+    def release_owner(self, job_id, node_id):
+        with self.lock:
+            if self.owners.get(job_id, {}).get("nodeId") == node_id:
+                del self.owners[job_id]
+                
+    def get_owner(self, job_id):
+        with self.lock:
+            return self.owners.get(job_id)
+            
+    def save_task(self, task):
+        with self.lock:
+            self.tasks[task["taskId"]] = task
+            # Like TASKS, keep at most MAX_FINISHED_TASKS finished tasks in memory
+            if len(self.tasks) > MAX_FINISHED_TASKS:
+                finished = [task_id for task_id, saved in self.tasks.items() if saved["finishedAt"] is not None]
+                for task_id in finished[:max(0, len(finished) - MAX_FINISHED_TASKS)]:
+                    del self.tasks[task_id]
+                    
+    def get_task(self, task_id):
+        with self.lock:
+            return self.tasks.get(task_id)
+            
+    def job_status(self, job_id):
+        with self.lock:
+            tasks = [task for task in self.tasks.values() if task["jobId"] == job_id]
+        return max(tasks, key=lambda task: task["createdAt"])["status"] if tasks else None
+        
+    def prune(self, max_age):
+        cutoff = time.time() - max_age
+        with self.lock:
+            for task_id in [task_id for task_id, task in self.tasks.items() if (task["finishedAt"] or time.time()) < cutoff]:
+                del self.tasks[task_id]
+
+class SQLiteJobState:
+    """Job state in a SQLite database shared by the instances on one host (or in tests)"""
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS workspaces "
+                "(job_id TEXT PRIMARY KEY, node_id TEXT NOT NULL, node_url TEXT, updated_at REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, job_id TEXT NOT NULL, "
+                "status TEXT NOT NULL, node_id TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL, data TEXT NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_by_job ON tasks (job_id, created_at)")
+            
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+        
+    def set_owner(self, job_id, node_id, node_url):
+        with self.connect() as db:
+            db.execute(
+                "INSERT INTO workspaces VALUES (?, ?, ?, ?) ON CONFLICT (job_id) DO UPDATE SET "
+                "node_id = excluded.node_id, node_url = excluded.node_url, updated_at = excluded.updated_at",
+                (job_id, node_id, node_url, time.time())
+            )
+            
+    def release_owner(self, job_id, node_id):
+        with self.connect() as db:
+            db.execute("DELETE FROM workspaces WHERE job_id = ? AND node_id = ?", (job_id, node_id))
+            
+    def get_owner(self, job_id):
+        with self.connect() as db:
+            row = db.execute("SELECT node_id, node_url, updated_at FROM workspaces WHERE job_id = ?", (job_id,)).fetchone()
+        return {"nodeId": row[0], "nodeUrl": row[1], "updatedAt": row[2]} if row else None
+        
+    def save_task(self, task):
+        with self.connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (task["taskId"], task["jobId"], task["status"], task.get("nodeId") or NODE_ID,
+                 task["createdAt"], time.time(), json.dumps(task, default=str))
+            )
+            
+    def get_task(self, task_id):
+        with self.connect() as db:
+            row = db.execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+        
+    def job_status(self, job_id):
+        with self.connect() as db:
+            row = db.execute(
+                "SELECT status FROM tasks WHERE job_id = ? ORDER BY created_at DESC LIMIT 1", (job_id,)
+            ).fetchone()
+        return row[0] if row else None
+        
+    def prune(self, max_age):
+        with self.connect() as db:
+            db.execute(
+                "DELETE FROM tasks WHERE status IN ('succeeded', 'failed') AND json_extract(data, '$.finishedAt') < ?",
+                (time.time() - max_age,)
+            )
+
+def open_job_state(url):
+    """Create the job state backend named by JOB_STATE_URL"""
+    if url in ("", "memory"):
+        return MemoryJobState()
+    if url.startswith("sqlite://"):
+        return SQLiteJobState(url[len("sqlite://"):])
+    raise ValueError(f"Unsupported JOB_STATE_URL: {url}")
+
+job_state = open_job_state(JOB_STATE_URL)
+# Writes go through one thread so they land in order without blocking the loop
+job_state_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-state")
+node_client: Optional[httpx.AsyncClient] = None
+
+def claim_workspace(job_id):
+    """Record that this node has the job's workspace"""
+    try:
+        job_state.set_owner(job_id, NODE_ID, NODE_URL)
+    except Exception as e:
+        print(f"Could not record owner of job {job_id}: {e}")
+
+def release_workspace(job_id):
+    """Record that this node no longer has the job's workspace"""
+    try:
+        job_state.release_owner(job_id, NODE_ID)
+    except Exception as e:
+        print(f"Could not release owner of job {job_id}: {e}")
+
+def record_task(task):
+    """Save a task's current state to the job state backend in the background"""
+    view = {**task_view(task), "nodeId": NODE_ID}
+    def save():
+        try:
+            job_state.save_task(view)
+        except Exception as e:
+            print(f"Could not record task {view['taskId']}: {e}")
+    job_state_executor.submit(save)
+
+def workspace_is_local(job_id):
+    """Whether the job's project is on this node, on disk or pending"""
+    with pending_scaffolds_lock:
+        if job_id in PENDING_SCAFFOLDS:
+            return True
+    return os.path.isdir(f"{WORKSPACE_ROOT}/{job_id}")
+
+async def proxy_request(request, node_url, body=None):
+    """Forward a request to another node and stream its response back"""
+    global node_client
+    if node_client is None:
+        node_client = httpx.AsyncClient(timeout=httpx.Timeout(NODE_PROXY_TIMEOUT, connect=5))
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+    headers[NODE_HEADER] = NODE_ID
+    upstream = node_client.build_request(
+        request.method,
+        f"{node_url.rstrip('/')}{request.url.path}",
+        params=list(request.query_params.multi_items()),
+        headers=headers,
+        content=await request.body() if body is None else body
+    )
+    response = await node_client.send(upstream, stream=True)
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers={name: value for name, value in response.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS},
+        background=BackgroundTask(response.aclose)
+    )
+
+async def route_to_owner(request, job_id):
+    """Proxy a request for a job whose workspace is on another node; None to handle it here"""
+    if request.headers.get(NODE_HEADER) or workspace_is_local(job_id):
+        return None
+    try:
+        owner = await asyncio.to_thread(job_state.get_owner, job_id)
+    except Exception as e:
+        print(f"Could not look up owner of job {job_id}: {e}")
+        return None
+    if not owner or owner["nodeId"] == NODE_ID or not owner.get("nodeUrl"):
+        return None
+    try:
+        print(f"Proxying {request.method} {request.url.path} to node {owner['nodeId']}")
+        return await proxy_request(request, owner["nodeUrl"])
+    except httpx.TransportError as e:
+        print(f"Node {owner['nodeId']} is unreachable ({e}), handling job {job_id} here")
+        return None
+
+async def restore_if_missing(job_id):
+    """Bring a job's workspace onto this node (from memory or storage) if it is not here"""
+    if await asyncio.to_thread(materialize_scaffold, job_id) or os.path.isdir(f"{WORKSPACE_ROOT}/{job_id}") or not storage:
+        return
+    try:
+        await asyncio.to_thread(ensure_workspace, job_id)
+    except FileNotFoundError:
+        pass
+
+# Job queue and worker pool
+#
+# /build and /improve run npm and gpte, which can take minutes. Instead of doing
+# that work inside the request handler (and blocking the event loop for every
+# other request), the handlers put a task on a bounded queue and a fixed pool of
+# workers runs it in a thread. Tasks on the same project are serialized without
+# tying up workers: a task for a job that is already running waits in that job's
+# pending_tasks list and runs after it, and a job whose workspace is locked by a
+# PATCH or another server process goes back on the queue to be retried.
+TASKS: "OrderedDict[str, dict]" = OrderedDict()
+task_queue: Optional[asyncio.Queue] = None
+worker_tasks: List[asyncio.Task] = []
+project_locks: Dict[str, asyncio.Lock] = {}
+pending_tasks: Dict[str, deque] = {}
+
+def run_build_task(task):
+    return build_project(task["jobId"])
+
+def run_improve_task(task):
+    return improve_project(task["jobId"], task["payload"]["prompt"])
+
+TASK_HANDLERS = {
+    "build": run_build_task,
+    "improve": run_improve_task,
+}
+
+def task_view(task):
+    """Public view of a task record"""
+    return {
+        "taskId": task["taskId"],
+        "jobId": task["jobId"],
+        "kind": task["kind"],
+        "status": task["status"],
+        "createdAt": task["createdAt"],
+        "startedAt": task["startedAt"],
+        "finishedAt": task["finishedAt"],
+        "result": task["result"],
+        "error": task["error"],
+        "spans": task["spans"],
+        "usage": task["usage"],
+        "statusUrl": f"/tasks/{task['taskId']}",
+    }
+
+def job_has_active_task(job_id):
+    """Whether a build or improve for the job is queued or running"""
+    return any(task["jobId"] == job_id and task["status"] in ("queued", "running") for task in TASKS.values())
+
+def find_active_task(kind, job_id, dedupe_key):
+    """Find a queued or running task with the same kind, job and dedupe key"""
+    for task in TASKS.values():
+        if (task["kind"] == kind and task["jobId"] == job_id and task["status"] in ("queued", "running")
+                and task["payload"].get("dedupeKey") == dedupe_key):
+            return task
+    return None
+
+def prune_finished_tasks():
+    """Forget the oldest finished tasks once more than MAX_FINISHED_TASKS are kept"""
+    finished = [task_id for task_id, task in TASKS.items() if task["status"] in ("succeeded", "failed")]
+    for task_id in finished[:max(0, len(finished) - MAX_FINISHED_TASKS)]:
+        del TASKS[task_id]
+
+def queued_task_count():
+    """Tasks waiting to run, on the queue or behind another task of their job"""
+    return sum(1 for task in TASKS.values() if task["status"] == "queued")
+
+def enqueue_task(kind, job_id, payload=None):
+    """Create a task and put it on the queue, rejecting it if the queue is full"""
+    if task_queue is None:
+        raise HTTPException(status_code=503, detail="Task workers are not running")
+    if queued_task_count() >= MAX_QUEUED_TASKS:
+        print(f"Task queue full, rejecting {kind} for job {job_id}")
+        raise HTTPException(
+            status_code=503,
+            detail="Too many queued jobs, try again later",
+            headers={"Retry-After": "10"},
+        )
+        
+    task = {
+        "taskId": str(uuid.uuid4()),
+        "jobId": job_id,
+        "kind": kind,
+        "payload": payload or {},
+        "status": "queued",
+        "createdAt": time.time(),
+        "startedAt": None,
+        "finishedAt": None,
+        "result": None,
+        "error": None,
+        "spans": [],
+        "usage": [],
+        "future": asyncio.get_running_loop().create_future(),
+    }
+    
+    try:
+        task_queue.put_nowait(task)
+    except asyncio.QueueFull:
+        print(f"Task queue full, rejecting {kind} for job {job_id}")
+        raise HTTPException(
+            status_code=503,
+            detail="Too many queued jobs, try again later",
+            headers={"Retry-After": "10"},
+        )
+        
+    TASKS[task["taskId"]] = task
+    record_task(task)
+    prune_finished_tasks()
+    print(f"Queued {kind} task {task['taskId']} for job {job_id} ({queued_task_count()} waiting)")
+    return task
+
+async def wait_for_task(task):
+    """Wait for a task to finish without blocking the event loop and return its result"""
+    await asyncio.shield(task["future"])
+    if task["status"] == "failed":
+        raise HTTPException(status_code=500, detail=task["error"])
+    return task["result"]
+
+async def execute_task(task):
+    """Run a single task in a thread; the caller holds the project lock"""
+    task["status"] = "running"
+    task["startedAt"] = time.time()
+    record_task(task)
+    observe("task_queue_wait_seconds", task["startedAt"] - task["createdAt"], kind=task["kind"])
+    print(f"Running {task['kind']} task {task['taskId']} for job {task['jobId']}")
+    
+    # Stages timed in the worker thread are recorded on the task
+    current_spans.set(task["spans"])
+    current_usage.set(task["usage"])
+    try:
+        task["result"] = await asyncio.to_thread(TASK_HANDLERS[task["kind"]], task)
+        task["status"] = "succeeded"
+    except Exception as e:
+        print(f"Error in {task['kind']} task {task['taskId']}: {e}")
+        traceback.print_exc()
+        task["error"] = str(e)
+        task["status"] = "failed"
+    finally:
+        task["finishedAt"] = time.time()
+        observe("task_seconds", task["finishedAt"] - task["startedAt"], kind=task["kind"])
+        inc_counter("tasks_total", kind=task["kind"], status=task["status"])
+        if not task["future"].done():
+            task["future"].set_result(task["status"])
+        record_task(task)
+
+def resume_job(job_id):
+    """Put a job whose workspace was locked back on the queue"""
+    try:
+        task_queue.put_nowait({"resumeJob": job_id})
+    except asyncio.QueueFull:
+        asyncio.get_running_loop().call_later(WORKSPACE_LOCK_POLL, resume_job, job_id)
+
+async def run_job_tasks(job_id):
+    """Run a job's pending tasks in order while its workspace lock is free
+
+    If the lock is held (by a PATCH or another server process) the job is
+    retried after WORKSPACE_LOCK_POLL seconds instead of keeping the worker.
+    """
+    pending = pending_tasks[job_id]
+    while pending:
+        try:
+            async with workspace_lock(job_id, 0):
+                await execute_task(pending.popleft())
+        except asyncio.TimeoutError:
+            asyncio.get_running_loop().call_later(WORKSPACE_LOCK_POLL, resume_job, job_id)
+            return
+        await asyncio.to_thread(refresh_workspace, job_id)
+        await enforce_workspace_budget()
+    del pending_tasks[job_id]
+
+async def prune_job_state():
+    """Drop expired tasks from the job state every JOB_STATE_PRUNE_INTERVAL seconds"""
+    while True:
+        try:
+            await asyncio.to_thread(job_state.prune, JOB_STATE_TASK_TTL)
+        except Exception as e:
+            print(f"Could not prune job state: {e}")
+        await asyncio.sleep(JOB_STATE_PRUNE_INTERVAL)
+
+async def task_worker(worker_id):
+    """Take tasks off the queue forever, leaving tasks of busy jobs to the worker running that job"""
+    while True:
+        task = await task_queue.get()
+        try:
+            if "resumeJob" in task:
+                await run_job_tasks(task["resumeJob"])
+            elif task["jobId"] in pending_tasks:
+                pending_tasks[task["jobId"]].append(task)
+            else:
+                pending_tasks[task["jobId"]] = deque([task])
+                await run_job_tasks(task["jobId"])
+        finally:
+            task_queue.task_done()
+
+@app.on_event("startup")
+async def start_task_workers():
+    global task_queue, event_loop
+    event_loop = asyncio.get_running_loop()
+    task_queue = asyncio.Queue(maxsize=MAX_QUEUED_TASKS)
+    for worker_id in range(TASK_WORKERS):
+        worker_tasks.append(asyncio.create_task(task_worker(worker_id)))
+    print(f"Started {TASK_WORKERS} task workers (queue limit {MAX_QUEUED_TASKS})")
+    await asyncio.to_thread(load_workspaces)
+    await asyncio.to_thread(ensure_bucket_exists)
+    worker_tasks.append(asyncio.create_task(prune_job_state()))
+    worker_tasks.append(asyncio.create_task(sweep_prompt_cache()))
+    print(f"Node {NODE_ID} ({NODE_URL or 'not reachable by other nodes'}) using job state {JOB_STATE_URL}")
+
+@app.on_event("shutdown")
+async def stop_task_workers():
+    for worker in worker_tasks:
+        worker.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+    worker_tasks.clear()
+    if storage:
+        await storage.close()
+    if node_client:
+        await node_client.aclose()
+    storage_io_executor.shutdown(wait=False, cancel_futures=True)
+    if asset_pool:
+        asset_pool.shutdown(wait=False, cancel_futures=True)
+
+@app.get("/tasks/{task_id}")
+async def get_task(task_id: str):
+    """Return the status of a queued build or improve task, from any node"""
+    task = TASKS.get(task_id)
+    if task:
+        return task_view(task)
+    shared = await asyncio.to_thread(job_state.get_task, task_id)
+    if not shared:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return shared
+
+@app.get("/metrics")
+async def get_metrics():
+    """Expose metrics in the Prometheus text format"""
+    set_gauge("tasks_in_flight", sum(1 for task in TASKS.values() if task["status"] == "running"))
+    set_gauge("tasks_queued", queued_task_count())
+    workspaces = workspace_stats()
+    set_gauge("workspace_bytes", workspaces["bytes"])
+    set_gauge("workspaces", workspaces["count"])
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def get_stats():
+    """Return queue and worker statistics"""
+    by_status: Dict[str, int] = {}
+    for task in TASKS.values():
+        by_status[task["status"]] = by_status.get(task["status"], 0) + 1
+    return {
+        "tasks": {
+            "workers": TASK_WORKERS,
+            "queued": queued_task_count(),
+            "queueLimit": MAX_QUEUED_TASKS,
+            "byStatus": by_status,
+        },
+        "buildCache": BUILD_CACHE_STATS,
+        "promptCache": {**PROMPT_CACHE_STATS, "entries": len(PROMPT_CACHE)},
+        "previewCache": {**HOT_FILE_STATS, "entries": len(HOT_FILES)},
+        "signedUrls": {**SIGNED_URL_STATS, "entries": len(SIGNED_URLS)},
+        "workspaces": workspace_stats(),
+    }
@@ -55,9 +55,11 @@ export async function generateGame(prompt: string): Promise<GenerationResponse>
   try {
     console.log('Generating game with prompt:', prompt);
     
+    // Retries send the same requestId so the server hands back the same project
+    const requestId = crypto.randomUUID();
     const response = await retryWithBackoff(async () => {
       const { data, error } = await supabase.functions.invoke('generate-game/generate', {
-        body: { prompt }
+        body: { prompt, requestId }
       });
 
       if (error) {
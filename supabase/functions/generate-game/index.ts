@@ -9,6 +9,36 @@ const corsHeaders = {
   'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
 }
 
+// /build and /improve queue a task and answer 202 with its status URL
+const TASK_POLL_INTERVAL_MS = 2000;
+const TASK_POLL_TIMEOUT_MS = 140000;
+
+// Wait for a queued task to finish and return its result (the old synchronous response)
+async function waitForTask(response: Response, label: string) {
+  const task = await response.json()
+  if (response.status !== 202) {
+    return task
+  }
+
+  const deadline = Date.now() + TASK_POLL_TIMEOUT_MS;
+  while (Date.now() < deadline) {
+    await new Promise((resolve) => setTimeout(resolve, TASK_POLL_INTERVAL_MS));
+    const statusResponse = await fetch(`${RENDER_URL}${task.statusUrl}`)
+    if (!statusResponse.ok) {
+      const errorText = await statusResponse.text();
+      throw new Error(`${label} status error: ${statusResponse.status} - ${errorText}`)
+    }
+    const status = await statusResponse.json()
+    if (status.status === 'succeeded') {
+      return status.result
+    }
+    if (status.status === 'failed') {
+      throw new Error(`${label} failed: ${status.error}`)
+    }
+  }
+  throw new Error(`${label} is still running (task ${task.taskId})`)
+}
+
 serve(async (req) => {
   // Handle CORS preflight requests
   if (req.method === 'OPTIONS') {
@@ -26,7 +56,7 @@ serve(async (req) => {
     console.log('Path:', path);
     
     if (path === 'generate') {
-      const { prompt } = await req.json()
+      const { prompt, requestId } = await req.json()
 
       if (!prompt) {
         return new Response(
@@ -43,9 +73,13 @@ serve(async (req) => {
 
       try {
         // Call Render service
+        // requestId lets the server recognise retries of the same request
         const response = await fetch(`${RENDER_URL}/run`, {
           method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
+          headers: {
+            'Content-Type': 'application/json',
+            ...(requestId ? { 'Idempotency-Key': requestId } : {})
+          },
           body: JSON.stringify({ prompt })
         })
 
@@ -117,7 +151,7 @@ serve(async (req) => {
         throw new Error(`Build service error: ${response.status} - ${errorText}`)
       }
 
-      const data = await response.json()
+      const data = await waitForTask(response, 'Build')
       
       return new Response(
         JSON.stringify(data),
@@ -157,7 +191,7 @@ serve(async (req) => {
         throw new Error(`Improve service error: ${response.status} - ${errorText}`)
       }
 
-      const data = await response.json()
+      const data = await waitForTask(response, 'Improve')
       
       return new Response(
         JSON.stringify(data),